@@ -4,10 +4,16 @@
         * Atlanta (http://www.frbatlanta.org/banking/reporting/fry6/)
         * St. Louis (http://www.stlouisfed.org/bsr/y6/)
 
+A run that leaves files undownloaded exits with status 2; the next run
+retries them.
+
 Usage:
-    scrapefrb [-a]
-    scrapefrb [-a --workpath=<path>]
-    scrapefrb --workpath=<path>
+    scrapefrb [options]
+    scrapefrb bench [options]
+    scrapefrb query [options]
+    scrapefrb export [options]
+    scrapefrb worker [options]
+    scrapefrb verify [options]
     scrapefrb -h | --help
     scrapefrb --version
 
@@ -15,22 +21,129 @@ Options:
     -h --help           Show this help screen.
     --version           Show version.
     --workpath=<path>   Customize the working/output directory.
-    -a --alldown        Download all files. By default, only new files are downloaded.
+    -a --alldown        Download all listed files. By default, the files of stored
+                        filings that are not downloaded yet.
+    -j --jobs=<n>       Number of banks to scrape concurrently [default: 1].
+    --host-limit=<n>    Maximum concurrent requests per host [default: 4].
+    --transfers=<n>     Maximum concurrent file downloads [default: 8].
+    --max-rate=<n>      Requests per second ceiling for any one host; the
+                        rate otherwise adapts to each site's replies and
+                        robots.txt crawl-delay. 0 for none [default: 0].
+    --no-rate-limit     Send requests as fast as the host limit allows.
+    --timeout=<sec>     Read timeout for every HTTP request [default: 60].
+    --retries=<n>       Retries, with backoff, for 5xx replies and connection
+                        errors [default: 4].
+    --no-cache          Do not use or update the listing page cache.
+    --stl-pager=<mode>  How to page through St. Louis results: 'auto' requests
+                        the largest page size and fans out over the pager
+                        links, 'chain' posts one page at a time [default: auto].
+    --wal               Use SQLite write-ahead logging for frb_files.db.
+    -i --incremental    Stop crawling at documents that are already stored, and
+                        only request years from the newest stored year on.
+    --since=<year>      Incremental crawl of filings from <year> on.
+    --stream            Stream each bank's documents through insert and download
+                        while it is still being scraped.
+    --queue-size=<n>    Batches buffered between streaming stages [default: 4].
+    --refetch-changed   Re-download files whose ETag, Last-Modified or size
+                        changed on the server since they were downloaded.
+    --dedupe            Store each unique file once under blobs/, named by
+                        its SHA-256, and link the names in downloads/ to it.
+    --statsd=<addr>     Send run metrics to a StatsD server at host:port.
+    --prom-file=<path>  Write run metrics to a Prometheus textfile.
+    --record            Append every raw listing response to
+                        frb_archive.jsonl.gz in the workpath.
+    --replay            Scrape from frb_archive.jsonl.gz instead of the
+                        network. Nothing is downloaded; the next live run
+                        downloads the files of the filings stored.
+    --daemon            Keep running and poll each bank on its own interval,
+                        incrementally. Polls more often after new filings
+                        and in filing season (March to May). Next runs are
+                        shown in frb_daemon_status.json in the workpath.
+    --poll-min=<min>    Shortest daemon polling interval [default: 30].
+    --poll-max=<min>    Longest daemon polling interval [default: 1440].
+    --queue-downloads   Queue new files in the download_jobs table for
+                        scrapefrb worker instead of downloading them.
+
+Worker options (scrapefrb worker downloads the queued files; run any number
+of workers, on any machine that shares the workpath):
+    --claim=<n>         Jobs leased per batch [default: 20].
+    --lease=<sec>       Lease length; a job whose worker stops renewing it
+                        is handed to another worker [default: 300].
+    --follow            Wait for new jobs instead of exiting once the queue
+                        is empty.
+
+Verify options (scrapefrb verify checks every file in downloads/, writes
+frb_verify.json and queues broken files for scrapefrb worker):
+    --procs=<n>         Processes hashing files; 0 for one per CPU
+                        [default: 0].
+    --recheck           Check every file, not only those that changed or
+                        failed since the last audit.
+
+Benchmark options (scrapefrb bench runs every bank against a local stand-in
+server, in a throwaway directory, and writes frb_bench.json to the workpath):
+    --bench-docs=<n>    Filings served per site [default: 500].
+    --bench-years=<n>   Years the filings are spread over [default: 5].
+    --pdf-size=<kb>     Size of each served PDF [default: 64].
+    --latency=<ms>      Delay added to every response [default: 0].
+    --error-rate=<p>    Fraction of responses answered with HTTP 503
+                        [default: 0].
+
+Query and export options (scrapefrb query searches the stored filings in
+frb_files.db; scrapefrb export streams them to a file):
+    --rssd=<id>         Filings of one RSSD ID.
+    --name=<text>       Company name search; each word matches as a prefix.
+    --fuzzy             Also match misspelled names, closest first (query
+                        only).
+    --year=<range>      Report year, or a range such as 2010-2013.
+    --bank=<code>       Bank code: C (Chicago), A (Atlanta) or S (St. Louis).
+    --posted-since=<d>  Posted on or after this date (YYYY-MM-DD).
+    --posted-until=<d>  Posted on or before this date (YYYY-MM-DD).
+    --limit=<n>         Maximum rows to show [default: 100].
+    --json              Print JSON instead of a table.
+    --after-id=<n>      Only filings with a doc_id above <n>.
+    --inserted-since=<d>  Only filings stored on or after this date.
+    --format=<fmt>      Export format: csv, jsonl or parquet (needs pyarrow)
+                        [default: csv].
+    --output=<path>     Export file. Defaults to frb_export.<format> in the
+                        workpath.
+    --batch-size=<n>    Rows read from the database at a time [default: 1000].
+    --since-last        Export only the filings stored since the previous
+                        incremental export to the same file, into a new
+                        file named with the last doc_id it holds.
 """
 
 __author__ = 'Sean J. Herman'
 __version__ = '0.5.0'
 
 import docopt
+import logging
 import os
+import signal
 import sys
+from multiprocessing.pool import ThreadPool
 from src import frblogger
 from src.bankhandler import FRB
+from src.fetchpool import FetchPool
+from src.resultshandler import FRBDownload
+from src.httpcache import HTTPCache
+from src.httpclient import HTTPClient
+from src.metrics import Metrics
+from src.ratelimit import RateLimiter
+from src.archive import ResponseArchive
 from src.stlfrb import StLouis
 from src.cfrb import Chicago
 from src.afrb import Atlanta
+from src.pipeline import Pipeline
+from src.benchserver import BenchServer
+from src.benchmark import Benchmark, format_report
+from src import query
+from src.export import Exporter
+from src.scheduler import Scheduler
+from src.jobqueue import DownloadQueue, Worker
+from src.verify import Auditor
 
 OUTPUT_DIRECTORIES = ['', 'downloads']
+BANKS = [StLouis, Chicago, Atlanta]
 
 def main():
     args = docopt.docopt(__doc__, version=__version__)
@@ -38,6 +151,43 @@ def main():
     if args['--alldown']:
         FRB.set_download_all()
 
+    if args['--since']:
+        try:
+            FRB.set_incremental(int(args['--since']))
+        except ValueError:
+            print('Invalid --since year: %s' % args['--since'])
+            sys.exit(1)
+    elif args['--incremental']:
+        FRB.set_incremental()
+
+    if args['--refetch-changed']:
+        FRBDownload.set_refetch_changed()
+
+    if args['--dedupe']:
+        FRBDownload.set_dedupe()
+
+    if args['--queue-downloads']:
+        FRBDownload.set_queue()
+
+    if args['--no-cache']:
+        HTTPCache.set_enabled(False)
+
+    if args['--no-rate-limit']:
+        RateLimiter.set_enabled(False)
+
+    if args['--record'] and args['--replay']:
+        print('--record and --replay cannot be used together')
+        sys.exit(1)
+    elif args['--record']:
+        ResponseArchive.set_record()
+    elif args['--replay']:
+        ResponseArchive.set_replay()
+
+    if args['--stl-pager'] not in ('auto', 'chain'):
+        print('Invalid --stl-pager mode: %s' % args['--stl-pager'])
+        sys.exit(1)
+    StLouis.set_pager_mode(args['--stl-pager'])
+
     if args['--workpath']:
         working_path = args['--workpath']
     else:
@@ -59,16 +209,239 @@ def main():
     if not(os.path.exists(working_path)):
         os.mkdir(working_path)
 
+    try:
+        jobs = max(1, int(args['--jobs']))
+        FetchPool.set_host_limit(args['--host-limit'])
+        FRBDownload.set_transfers(args['--transfers'])
+        Pipeline.set_queue_size(args['--queue-size'])
+        HTTPClient.set_timeout(args['--timeout'])
+        HTTPClient.set_retries(args['--retries'])
+        RateLimiter.set_max_rate(args['--max-rate'])
+        Scheduler.set_intervals(args['--poll-min'], args['--poll-max'])
+        Worker.set_batch_size(args['--claim'])
+        DownloadQueue.set_lease(args['--lease'])
+        Auditor.set_processes(args['--procs'])
+        if args['--statsd']:
+            Metrics.set_statsd(args['--statsd'])
+    except ValueError:
+        logger.error('Invalid numeric option value')
+        sys.exit(1)
+
+    if args['--prom-file']:
+        Metrics.set_prometheus_file(args['--prom-file'])
+
+    if args['bench']:
+        run_benchmark(args, working_path)
+        return
+
     FRB.set_working_path(working_path)
 
-    frbs = [StLouis(), Chicago(), Atlanta()]
-    
-    for f in frbs:
+    if args['--wal']:
+        FRB.DB.enable_wal()
+
+    if args['query']:
+        run_query(args)
+        return
+
+    if args['export']:
+        run_export(args, working_path)
+        return
+
+    if args['worker']:
+        run_worker(args)
+        return
+
+    if args['verify']:
+        run_verify(args, working_path)
+        return
+
+    run = stream_bank if args['--stream'] else run_bank
+
+    if args['--daemon']:
+        try:
+            run_daemon(run, jobs, working_path)
+        finally:
+            ResponseArchive.close()
+        return
+
+    Metrics.reset()
+
+    try:
+        run_banks(run, jobs)
+    finally:
+        ResponseArchive.close()
+
+    if RateLimiter.ENABLED:
+        logger.info('Request rates reached per host: %s' % RateLimiter.rates())
+    write_report(working_path)
+
+    # Failed files keep no manifest entry, so the next run tries them again
+    failed = Metrics.total('files_failed')
+    if failed:
+        logger.warning('%d files failed to download; the next run retries them' % failed)
+        sys.exit(2)
+
+def run_banks(run, jobs):
+    logger = logging.getLogger('root')
+    if jobs > 1:
+        # Each bank scrapes, normalizes, compares, inserts and downloads on
+        # its own worker thread. FRB.DB serializes the shared connection.
+        logger.info('Running %d banks with %d concurrent jobs' % (len(BANKS), jobs))
+        pool = ThreadPool(min(jobs, len(BANKS)))
+        try:
+            pool.map(lambda bank: run_isolated(run, bank), BANKS)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for bank in BANKS:
+            run_isolated(run, bank)
+
+def run_isolated(run, bank):
+    # One bank's failure must not stop the others or the run report
+    try:
+        run(bank)
+    except Exception:
+        logging.getLogger('root').exception('%s failed' % bank.__name__)
+        Metrics.incr(Metrics.label(bank.URL), 'bank_errors')
+
+def run_daemon(run, jobs, working_path):
+    # The database connection and HTTP session stay open between runs
+    logger = logging.getLogger('root')
+    if not(FRB.INCREMENTAL):
+        FRB.set_incremental()
+
+    def poll(bank):
+        label = Metrics.label(bank.URL)
+        inserted = Metrics.counter(label, 'rows_inserted')
+        run(bank)
+        return Metrics.counter(label, 'rows_inserted') - inserted
+
+    scheduler = Scheduler(BANKS, poll)
+    Scheduler.set_working_path(working_path)
+    stop_on_signal(scheduler.stop, 'Stopping after the current run')
+
+    logger.info('Daemon started, polling every %d to %d minutes'
+        % (Scheduler.MIN_INTERVAL // 60, Scheduler.MAX_INTERVAL // 60))
+    while scheduler.wait():
+        Metrics.reset()
+        scheduler.run_due(jobs)
+        write_report(working_path)
+    logger.info('Daemon stopped')
+
+def run_worker(args):
+    logger = logging.getLogger('root')
+    worker = Worker(FRBDownload.fetch_files, follow=args['--follow'])
+    stop_on_signal(worker.stop, 'Stopping after the current batch')
+
+    Metrics.reset()
+    try:
+        worker.run()
+        logger.info('Download jobs by state: %s' % DownloadQueue.counts())
+    finally:
+        DownloadQueue.close()
+    Metrics.publish()
+
+def run_verify(args, working_path):
+    logger = logging.getLogger('root')
+    try:
+        report = Auditor(FRB.DB, recheck=args['--recheck']).run()
+    finally:
+        DownloadQueue.close()
+    file_name = frblogger.write_report(working_path, report, 'frb_verify.json')
+    logger.info('Wrote verify report to %s' % file_name)
+    if report['broken']:
+        sys.exit(2)
+
+def stop_on_signal(stop, message):
+    def handler(signum, frame):
+        logging.getLogger('root').info(message)
+        stop()
+    signal.signal(signal.SIGTERM, handler)
+    signal.signal(signal.SIGINT, handler)
+
+def write_report(working_path):
+    logger = logging.getLogger('root')
+    report = Metrics.report()
+    try:
+        logger.info('Wrote run report to %s' % frblogger.write_report(working_path, report))
+    except IOError as e:
+        logger.warning('Could not write run report: %s' % e)
+    Metrics.publish(report)
+
+def run_query(args):
+    try:
+        document_query = query.DocumentQuery.from_args(args, limit=args['--limit'])
+    except ValueError as e:
+        print('Invalid query option: %s' % e)
+        sys.exit(1)
+
+    rows = document_query.rows(FRB.DB)
+    if args['--json']:
+        output = query.format_json(rows)
+    else:
+        output = query.format_table(rows)
+        output += '\n%d filings' % len(rows)
+    print(output.encode('utf-8'))
+
+def run_export(args, working_path):
+    logger = logging.getLogger('root')
+    file_format = args['--format'].lower()
+    file_name = args['--output']
+    if not(file_name):
+        file_name = os.path.join(working_path, 'frb_export.%s' % file_format)
+
+    try:
+        document_query = query.DocumentQuery.from_args(args)
+        # Exports match names exactly; similarity ranking is for query
+        document_query.fuzzy = False
+        Exporter.set_batch_size(args['--batch-size'])
+        exporter = Exporter(FRB.DB, document_query, file_name, file_format)
+    except ValueError as e:
+        logger.error('Invalid export option: %s' % e)
+        sys.exit(1)
+
+    Exporter.set_working_path(working_path)
+    count, last_id = exporter.run(incremental=args['--since-last'])
+    if last_id is not None:
+        logger.info('Last exported doc_id: %d' % last_id)
+
+def run_benchmark(args, working_path):
+    logger = logging.getLogger('root')
+    try:
+        server = BenchServer(docs=int(args['--bench-docs']),
+                             years=int(args['--bench-years']),
+                             pdf_size=int(float(args['--pdf-size']) * 1024),
+                             latency=float(args['--latency']) / 1000,
+                             error_rate=float(args['--error-rate']))
+    except ValueError:
+        logger.error('Invalid benchmark option value')
+        sys.exit(1)
+
+    server.start()
+    try:
+        report = Benchmark(server, stream=args['--stream']).run()
+    finally:
+        server.stop()
+
+    print(format_report(report))
+    file_name = frblogger.write_report(working_path, report, 'frb_bench.json')
+    logger.info('Wrote benchmark report to %s' % file_name)
+
+def stream_bank(bank):
+    with Metrics.timer(Metrics.label(bank.URL), 'total'):
+        Pipeline(bank).run()
+
+def run_bank(bank):
+    logger = logging.getLogger('root')
+    with Metrics.timer(Metrics.label(bank.URL), 'total'):
+        f = bank()
         if f.documents:
             f.insert()
-            f.download()
         else:
             logger.warning("No documents found at %s" % f.URL)
+        # Also retries the files earlier runs failed to download
+        f.download()
 
 def get_default_path():
     if getattr(sys, 'frozen', False):
@@ -1,4 +1,7 @@
 from bankhandler import FRB
+from fetchpool import FetchPool
+from httpcache import HTTPCache
+from metrics import Metrics
 import requests
 import logging
 import time
@@ -13,48 +16,55 @@ class Atlanta(FRB):
     DATE_FORMAT = ('%B, %d %Y %H:%M:%S')
     BANK_CODE = 'A'
 
-    def __init__(self):
-        super(Atlanta, self).__init__()
+    def __init__(self, run=True):
+        super(Atlanta, self).__init__(run)
 
-    def scrape(self):
-        json = {}
-        session = requests.Session()
-        years = self._get_years(session)
+    def iter_pages(self):
+        years = self._get_years()
         if years:
-            self._parse_files(years, session)
-        if self.documents:
-            self.table_headers = list(self.documents[0])
+            years = self._filter_years(years)
+        if years:
+            for docs in self._parse_files(years):
+                yield docs
 
-    def _get_years(self, session):
+    def _get_years(self):
         # Announce the commencement of the scraper
         self.logger.info("Beginning scrape of frbatlanta.org")
 
         # Get the list of years from the YearParser
         tail_url = '?{%22reader%22:%22getYearList%22}'
         full_url = Atlanta.URL + tail_url
-        req = requests.Request('GET', full_url)
-        prepped = req.prepare()
-        resp = session.send(prepped)
+        try:
+            resp = HTTPCache.request('GET', full_url)
+        except requests.RequestException as e:
+            self.logger.warning("No response: %s" % e)
+            return
         if resp.ok:
             return [str(y) for y in resp.json()]
 
-    def _parse_files(self, years, session):
-        # Request new JSON for each year, and parse the JSON
-        for year in years:
-            full_url = self._compose_full_url(year)
-            raw_json = self._get_json(full_url, session)
+    def _parse_files(self, years):
+        # Request new JSON for each year concurrently, then parse and yield
+        # the JSON in year order
+        urls = [self._compose_full_url(year) for year in years]
+        results = FetchPool.imap(self._get_json, urls, lambda url: url)
+        total = 0
+        for raw_json in results:
             if raw_json:
-                self._parse_json_docs(raw_json)
-        if self.documents:
-            self._add_urls()
+                with Metrics.timer(Metrics.label(Atlanta.URL), 'parse'):
+                    docs = self._parse_json_docs(raw_json)
+                if docs:
+                    total += len(docs)
+                    yield docs
 
-        self.logger.info("Parsed %d files from frbatlanta.org" % len(self.documents))
+        self.logger.info("Parsed %d files from frbatlanta.org" % total)
 
-    def _get_json(self, full_url, session):
+    def _get_json(self, full_url):
         self.logger.info("Please wait. Loading %s... " % full_url)
-        req = requests.Request('GET', full_url)
-        prepped = req.prepare()
-        resp = session.send(prepped)
+        try:
+            resp = HTTPCache.request('GET', full_url)
+        except requests.RequestException as e:
+            self.logger.warning("No response: %s" % e)
+            return
 
         if resp.ok:
             return resp.json()
@@ -62,16 +72,11 @@ class Atlanta(FRB):
             self.logger.warning("No response")
 
     def _parse_json_docs(self, raw_json):
-        # Parse out the columns
-        columns = [str(c) for c in raw_json['COLUMNS']]
-
-        for row in raw_json['DATA']:
-            clean_row = [str(e) for e in row]
-            self.documents.append(dict(zip(columns, clean_row)))
-
-    def _add_urls(self):
-        for doc in self.documents:
-            doc['URL'] = (Atlanta.DOC_PREFIX + doc['FILENAME'])
+        # Parse out the columns, and give each row its document URL
+        columns = [str(c) for c in raw_json['COLUMNS']] + ['URL']
+        file_index = columns.index('FILENAME')
+        rows = [row + [Atlanta.DOC_PREFIX + row[file_index]] for row in raw_json['DATA']]
+        return self.make_documents(columns, rows)
 
     def _compose_full_url(self, year):
         url = (Atlanta.URL + 
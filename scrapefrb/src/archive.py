@@ -0,0 +1,114 @@
+import gzip
+import json
+import logging
+import os
+import threading
+import time
+import zlib
+
+
+class ResponseArchive(object):
+    """Append-only archive of raw listing responses.
+
+    In record mode every listing response is appended to FILE_NAME as one
+    gzip-compressed JSON line, keyed like the HTTPCache by method, URL and
+    payload. In replay mode the scrapers are answered from the archive
+    alone, so parsing and normalization can be re-run without touching the
+    network. When a key was recorded more than once, the newest copy wins.
+    """
+    LOGGER = logging.getLogger('root')
+
+    FILE_NAME = 'frb_archive.jsonl.gz'
+    RECORD = False
+    REPLAY = False
+
+    _lock = threading.Lock()
+    _outfile = None
+    _index = None
+
+    @classmethod
+    def set_working_path(cls, path):
+        cls.FILE_NAME = os.path.join(path, cls.FILE_NAME)
+
+    @classmethod
+    def set_record(cls):
+        cls.RECORD = True
+
+    @classmethod
+    def set_replay(cls):
+        cls.REPLAY = True
+
+    @classmethod
+    def record(cls, key, method, url, params, data, resp):
+        entry = {
+            'key': key,
+            'method': method,
+            'url': url,
+            'params': params or None,
+            'data': data or None,
+            'final_url': resp.url,
+            'status': resp.status_code,
+            'encoding': resp.encoding,
+            'headers': dict(resp.headers),
+            # latin-1 maps every byte to one code point, so any body
+            # survives the round trip through JSON
+            'body': resp.content.decode('latin-1'),
+            'date': time.time()
+        }
+        line = json.dumps(entry) + '\n'
+        with cls._lock:
+            if cls._outfile is None:
+                # Appending starts a new gzip member; readers see one stream
+                cls._outfile = gzip.open(cls.FILE_NAME, 'ab')
+            cls._outfile.write(line)
+            # Keep everything written so far readable if the run dies
+            cls._outfile.flush(zlib.Z_SYNC_FLUSH)
+
+    @classmethod
+    def lookup(cls, key):
+        # The newest archived entry for key, or None
+        return cls._load().get(key)
+
+    @staticmethod
+    def body(entry):
+        return entry['body'].encode('latin-1')
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            if cls._outfile is not None:
+                cls._outfile.close()
+                cls._outfile = None
+
+    @classmethod
+    def _load(cls):
+        with cls._lock:
+            if cls._index is None:
+                cls._index = cls._read_index()
+            return cls._index
+
+    @classmethod
+    def _read_index(cls):
+        index = {}
+        if not(os.path.exists(cls.FILE_NAME)):
+            cls.LOGGER.warning('No archive at %s' % cls.FILE_NAME)
+            return index
+
+        start = time.time()
+        infile = gzip.open(cls.FILE_NAME, 'rb')
+        try:
+            for line in infile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                index[entry['key']] = entry
+        except (IOError, EOFError, zlib.error) as e:
+            # A run that was killed leaves the last member without a trailer
+            cls.LOGGER.warning('Archive ends early (%s); using %d responses read so far'
+                % (e, len(index)))
+        finally:
+            infile.close()
+        cls.LOGGER.info('Loaded %d archived responses in %0.2f seconds'
+            % (len(index), time.time() - start))
+        return index
@@ -1,10 +1,12 @@
 import logging
-import sqlite3
 import time
-import logging
-import os
-from datetime import datetime
 from resultshandler import FRBDB, FRBDownload
+from httpcache import HTTPCache
+from archive import ResponseArchive
+from jobqueue import DownloadQueue
+from document import Document
+from normalize import Normalizer
+from metrics import Metrics
 
 
 class FRB(object):
@@ -12,9 +14,11 @@ class FRB(object):
     """
     DATE_FORMAT = None
     BANK_CODE = None
-    DB = FRBDB()
+    DB = None
     WORK_PATH = None
     DOWNLOAD_ALL = False
+    INCREMENTAL = False
+    SINCE_YEAR = None
 
     @classmethod
     def set_working_path(cls, path):
@@ -22,88 +26,159 @@ class FRB(object):
         #print cls.WORK_PATH
         FRBDB.set_working_path(path)
         FRBDownload.set_working_path(path)
+        HTTPCache.set_working_path(path)
+        ResponseArchive.set_working_path(path)
+        DownloadQueue.set_working_path(path)
+        # Open the database only once its location is known
+        cls.DB = FRBDB()
+        FRBDownload.set_database(cls.DB)
 
     @classmethod
     def set_download_all(cls):
         cls.DOWNLOAD_ALL = True
 
-    def __init__(self):
+    @classmethod
+    def set_incremental(cls, since_year=None):
+        # With no explicit year, each bank starts from its newest stored year
+        cls.INCREMENTAL = True
+        cls.SINCE_YEAR = since_year
+
+    def __init__(self, run=True):
         self.documents = []
         self.new_documents = []
-        self.table_headers = []
-        self.key_map = {}
-        
+
         self.logger = logging.getLogger('root')
+        self.label = Metrics.label(self.URL)
+        self.normalizer = Normalizer.for_bank(type(self))
 
-        self.scrape()
-        if self.documents:
-            self._normalize()
-            self.compare()
+        # With run=False nothing is fetched, and the caller drives
+        # iter_pages() itself (see pipeline.Pipeline)
+        if run:
+            self.scrape()
+            if self.documents:
+                self._normalize()
+                self.compare()
         #self.insert()
         #self.download()
 
     def scrape(self):
-        pass
+        for docs in self.iter_pages():
+            self.documents += docs
+
+    def iter_pages(self):
+        # Yield lists of scraped Documents, one per page or year, as they
+        # are parsed
+        return iter([])
+
+    def make_documents(self, headers, rows):
+        # Build a Document from each row of values listed in header order
+        fields = self.normalizer.header_map(headers)
+        missing = [key for key in FRBDB.COLUMN_ORDER if key not in fields]
+        if missing:
+            raise ValueError('%s: no column for %s in %s'
+                % (self.NAME, ', '.join(missing), headers))
+        rssd, name, date, year, url = [fields[key] for key in FRBDB.COLUMN_ORDER]
+        code = self.BANK_CODE
+        return [Document(row[rssd], row[name], row[date], row[year], row[url], code)
+                for row in rows]
+
+    def since_year(self):
+        # The first year an incremental crawl needs to request, or None for
+        # a full crawl
+        if not(FRB.INCREMENTAL):
+            return None
+        if FRB.SINCE_YEAR is not None:
+            return FRB.SINCE_YEAR
+        return FRB.DB.newest_year(self.BANK_CODE)
+
+    def _filter_years(self, years):
+        since = self.since_year()
+        if since is None:
+            return years
+        kept = [y for y in years if int(y) >= since]
+        self.logger.info('Incremental crawl: requesting %d of %d years (%d and later)'
+            % (len(kept), len(years), since))
+        return kept
+
+    def _is_known(self, doc, since=None):
+        # True when doc is already stored, or predates an incremental crawl
+        if since is not None and isinstance(doc.year, int) and doc.year < since:
+            return True
+        return doc.key() in FRB.DB.old_keys
 
     def compare(self):
-        old_pairs = FRB.DB.old_id_pairs
-        self.new_documents = []
+        old_keys = FRB.DB.old_keys
 
-        if old_pairs:
-            self.logger.info('Fetched %d old documents' % len(old_pairs))
-            for d in self.documents:
-                new_pair = (d[self.key_map.get('RSSD')], d[self.key_map.get('Name')], d[self.key_map.get('Year')])
-                if new_pair not in old_pairs:
-                    self.new_documents.append(d)
+        if old_keys:
+            self.logger.info('Fetched %d old documents' % len(old_keys))
+            self.new_documents = self.find_new(self.documents)
             self.logger.info('Located %d total new documents for insert' % len(self.new_documents))
         else:
             self.new_documents = self.documents
             self.logger.info('No old documents fetched. All %d documents flagged as new' % len(self.new_documents))
 
+    def find_new(self, documents):
+        # The documents whose key is not stored yet
+        old_keys = FRB.DB.old_keys
+        with Metrics.timer(self.label, 'compare'):
+            return [d for d in documents if d.key() not in old_keys]
+
     def _normalize(self):
-        self._map_headers()
-        self._normalize_dates()
-        
-    def _map_headers(self):
-        # Pair generic headers with the site-specific header text
-        if self.table_headers:
-            # FRBDB.COLUMN_MAP contain the generic column names
-            for key, value in FRBDB.COLUMN_MAP.iteritems():
-                for column in self.table_headers:
-                    if key.lower() in column.lower():
-                        self.key_map[key] = column
-                        break
-
-    def _normalize_dates(self):
-        date_key = self.key_map.get('Date')
-        for doc in self.documents:
-            # Convert date string to datetime object
-            doc[date_key] = datetime.strptime(doc.get(date_key), self.DATE_FORMAT)
-
-    def insert(self):
-        self.logger.info('Inserting %d records' % len(self.new_documents))
+        self.documents = self.normalize_batch(self.documents)
+
+    def normalize_batch(self, documents):
+        # Returns the documents that could be normalized
+        with Metrics.timer(self.label, 'normalize'):
+            normalized = self.normalizer.normalize(documents)
+        if len(normalized) < len(documents):
+            Metrics.incr(self.label, 'rows_rejected', len(documents) - len(normalized))
+        return normalized
+
+    def insert(self, documents=None):
+        if documents is None:
+            documents = self.new_documents
+        self.logger.info('Inserting %d records' % len(documents))
         start = time.time()
-        try:
-            FRB.DB.insert_data(self.new_documents, self.key_map, self.BANK_CODE)
-        except sqlite3.IntegrityError as e:
-            self.logger.warning('Caught SQLite3 IntegrityError')
-            self.logger.warning(e)
+        inserted, present = FRB.DB.insert_documents(documents)
         stop = time.time()
-        diff = stop - stop
         diff = stop - start
+        Metrics.add_time(self.label, 'insert', diff)
+        Metrics.incr(self.label, 'rows_inserted', inserted)
+        self.logger.info('Inserted %d new records, %d already present' % (inserted, present))
         try:
-            rows_per_second = 1.0 * len(self.new_documents) / diff
+            rows_per_second = 1.0 * len(documents) / diff
             self.logger.info('Finished batch insert in %0.4f seconds (%d rows/second)' % 
                 (diff, rows_per_second))
         except ZeroDivisionError as e:
             self.logger.warning(e)
             self.logger.warning('Insert warning. Possible loss of data.')
+        return inserted, present
 
-    def download(self):
-        if FRB.DOWNLOAD_ALL:
-            downloads = self.documents
+    def download(self, documents=None, known=None):
+        # By default, every stored filing whose file is not downloaded yet
+        if documents is not None:
+            urls = [doc.url for doc in documents]
         else:
-            downloads = self.new_documents
+            urls = self.pending_urls()
+        return self.download_urls(urls, known)
+
+    def download_urls(self, urls, known=None):
+        # known are the documents whose already downloaded files are checked
+        # for changes (--refetch-changed) and missing links (--dedupe);
+        # by default all of this bank's documents
+        if known is None:
+            known = self.documents
 
-        url_key = self.key_map.get('URL')
-        FRBDownload.download([doc[url_key] for doc in downloads])
\ No newline at end of file
+        known_urls = [doc.url for doc in known] if FRBDownload.checks_known() else None
+        with Metrics.timer(self.label, 'download'):
+            return FRBDownload.download(urls, known_urls)
+
+    def pending_urls(self):
+        # This bank's stored filings with no downloaded file, including
+        # files that failed in earlier runs. With -a, every listed
+        # document as well.
+        urls = FRB.DB.undownloaded_urls(self.BANK_CODE)
+        if FRB.DOWNLOAD_ALL:
+            urls = [doc.url for doc in self.documents] + urls
+        seen = set()
+        return [url for url in urls if not(url in seen or seen.add(url))]
\ No newline at end of file
@@ -0,0 +1,240 @@
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from bankhandler import FRB
+from resultshandler import FRBDB, FRBDownload
+from httpcache import HTTPCache
+from archive import ResponseArchive
+from jobqueue import DownloadQueue
+from benchserver import BenchServer
+from httpclient import HTTPClient
+from metrics import Metrics
+from pipeline import Pipeline
+from stlfrb import StLouis
+from cfrb import Chicago
+from afrb import Atlanta
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak memory is reported as None
+    resource = None
+
+
+def peak_memory_mb():
+    # Process high-water mark of resident memory, in megabytes
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X and kilobytes elsewhere
+    if sys.platform == 'darwin':
+        return round(peak / 1048576.0, 1)
+    return round(peak / 1024.0, 1)
+
+
+def current_memory_mb():
+    # Resident memory right now, in megabytes; None where /proc is missing
+    try:
+        with open('/proc/self/statm') as infile:
+            pages = int(infile.read().split()[1])
+    except (IOError, OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+
+
+class MemorySampler(object):
+    """Samples resident memory on a thread while one stage runs, since
+    ru_maxrss only ever reports the high-water mark of the whole process.
+    growth() is how far the stage's peak rose above where it started.
+    """
+    INTERVAL = 0.02
+
+    def __init__(self):
+        self.start = self.peak = current_memory_mb()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if self.start is not None:
+            self.thread = threading.Thread(target=self._sample)
+            self.thread.daemon = True
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self._take()
+
+    def _sample(self):
+        while not(self.stopped.wait(MemorySampler.INTERVAL)):
+            self._take()
+
+    def _take(self):
+        current = current_memory_mb()
+        if current is not None:
+            self.peak = max(self.peak, current)
+
+    def growth(self):
+        if self.start is None:
+            return None
+        return round(self.peak - self.start, 1)
+
+
+class Benchmark(object):
+    """Runs the real scrapers and downloader against a BenchServer.
+
+    Each bank's class attributes are pointed at the local server for the
+    duration of the run, and a throwaway working directory holds the
+    database, cache and downloads. Every stage reports its wall time,
+    throughput, HTTP latency and how far resident memory rose during it.
+    """
+    LOGGER = logging.getLogger('root')
+
+    BANKS = [StLouis, Chicago, Atlanta]
+
+    def __init__(self, server, stream=False):
+        self.server = server
+        self.stream = stream
+        self.latencies = []
+        self.work_path = None
+
+    def run(self, banks=None):
+        banks = banks or Benchmark.BANKS
+        saved = self._point_at_server()
+        self.work_path = tempfile.mkdtemp(prefix='frb_bench_')
+        os.mkdir(os.path.join(self.work_path, 'downloads'))
+        FRB.set_working_path(self.work_path)
+        request = HTTPClient.__dict__['request']
+        HTTPClient.request = classmethod(self._timed(request.__func__))
+        start = time.time()
+        try:
+            results = dict((bank.__name__, self._run_bank(bank)) for bank in banks)
+        finally:
+            HTTPClient.request = request
+            HTTPClient.close()
+            FRB.DB.conn.close()
+            if HTTPCache._conn is not None:
+                HTTPCache._conn.close()
+                HTTPCache._conn = None
+            self._restore(saved)
+            shutil.rmtree(self.work_path, ignore_errors=True)
+
+        return {
+            'seconds': round(time.time() - start, 4),
+            'server': dict(self.server.stats(), docs=self.server.docs,
+                           pdf_size=self.server.pdf_size, latency=self.server.latency,
+                           error_rate=self.server.error_rate),
+            'peak_memory_mb': peak_memory_mb(),
+            'banks': results
+        }
+
+    def _point_at_server(self):
+        # Returns the original attribute values, for _restore
+        url = self.server.url
+        patches = [
+            (Chicago, 'URL', url + BenchServer.CHICAGO_PATH),
+            (Atlanta, 'URL', url + BenchServer.ATLANTA_PATH),
+            (Atlanta, 'DOC_PREFIX', url + BenchServer.ATLANTA_DOCS),
+            (StLouis, 'URL', url + BenchServer.STLOUIS_PATH),
+            (StLouis, 'DEFAULT_PAYLOAD', {}),
+        ]
+        # The working paths are replaced by the throwaway directory
+        paths = [(FRB, 'DB'), (FRB, 'WORK_PATH'), (FRBDB, 'FILE_NAME'),
+                 (FRBDownload, 'PATH_NAME'), (FRBDownload, 'BLOB_PATH'),
+                 (HTTPCache, 'FILE_NAME'),
+                 (ResponseArchive, 'FILE_NAME'), (DownloadQueue, 'FILE_NAME')]
+        saved = [(cls, name, cls.__dict__[name]) for cls, name in
+                 paths + [(cls, name) for cls, name, value in patches]]
+        for cls, name, value in patches:
+            setattr(cls, name, value)
+        return saved
+
+    def _restore(self, saved):
+        for cls, name, value in saved:
+            setattr(cls, name, value)
+
+    def _timed(self, func):
+        latencies = self.latencies
+
+        def request(cls, method, url, **kwargs):
+            start = time.time()
+            try:
+                return func(cls, method, url, **kwargs)
+            finally:
+                latencies.append(time.time() - start)
+        return request
+
+    def _run_bank(self, bank_class):
+        Benchmark.LOGGER.info('Benchmarking %s' % bank_class.NAME)
+        Metrics.reset()
+        stages = []
+
+        if self.stream:
+            summary = self._stage(stages, 'stream', lambda: Pipeline(bank_class).run(),
+                lambda s: len(s['succeeded']))
+        else:
+            bank = bank_class(run=False)
+            self._stage(stages, 'scrape', bank.scrape, lambda r: len(bank.documents))
+            self._stage(stages, 'normalize', bank._normalize, lambda r: len(bank.documents))
+            self._stage(stages, 'compare', bank.compare, lambda r: len(bank.documents))
+            self._stage(stages, 'insert', bank.insert, lambda r: r[0])
+            summary = self._stage(stages, 'download', bank.download,
+                lambda s: len(s['succeeded']))
+
+        counters = Metrics.report()['banks'].get(Metrics.label(bank_class.URL), {})
+        return {
+            'stages': stages,
+            'files_failed': len(summary['failed']),
+            'counters': counters.get('counters', {})
+        }
+
+    def _stage(self, stages, name, func, count_func):
+        del self.latencies[:]
+        start = time.time()
+        with MemorySampler() as memory:
+            result = func()
+        seconds = time.time() - start
+
+        items = count_func(result)
+        latencies = sorted(self.latencies)
+        stage = {
+            'stage': name,
+            'seconds': round(seconds, 4),
+            'items': items,
+            'items_per_sec': round(items / seconds, 1) if seconds else None,
+            'requests': len(latencies),
+            'latency_ms': None,
+            'memory_growth_mb': memory.growth()
+        }
+        if latencies:
+            stage['latency_ms'] = {
+                'mean': round(1000 * sum(latencies) / len(latencies), 2),
+                'p50': round(1000 * latencies[len(latencies) // 2], 2),
+                'p95': round(1000 * latencies[int(len(latencies) * 0.95)], 2),
+                'max': round(1000 * latencies[-1], 2)
+            }
+        stages.append(stage)
+        return result
+
+
+def format_report(report):
+    # A plain text table of every bank's stages
+    lines = ['%-8s %-10s %9s %8s %10s %6s %9s %9s %9s' % ('bank', 'stage', 'seconds',
+        'items', 'items/sec', 'reqs', 'p50 ms', 'p95 ms', 'mem +MB')]
+    for bank, result in sorted(report['banks'].iteritems()):
+        for s in result['stages']:
+            latency = s['latency_ms'] or {}
+            lines.append('%-8s %-10s %9.3f %8d %10s %6d %9s %9s %9s' % (bank, s['stage'],
+                s['seconds'], s['items'], s['items_per_sec'], s['requests'],
+                latency.get('p50', '-'), latency.get('p95', '-'), s['memory_growth_mb']))
+    server = report['server']
+    lines.append('%d requests served (%d injected errors, %d bytes) in %0.2f seconds, peak memory %s MB'
+        % (server['requests'], server['errors'], server['bytes'], report['seconds'],
+           report['peak_memory_mb']))
+    return '\n'.join(lines)
@@ -0,0 +1,300 @@
+import base64
+import BaseHTTPServer
+import json
+import logging
+import random
+import SocketServer
+import threading
+import time
+import urllib
+from urlparse import urlparse, parse_qsl
+
+# ASP.NET control names, shaped like the ones on stlouisfed.org
+STL_PAGER = 'ctl00$ContentPlaceHolder1$ucSearchReports$pgrSearchData$ctl00$ctl%02d'
+STL_PAGE_SIZE = 'ctl00$ContentPlaceHolder1$ucSearchReports$ddlPageSize'
+STL_HEADERS = ['Institution Name', 'City', 'State', 'RSSD ID', 'Report Year',
+               'Date Posted', 'Preview']
+ATL_COLUMNS = ['RSSD', 'NAME', 'CITY', 'STATE', 'DOCYEAR', 'DATEPOSTED', 'FILENAME']
+MONTHS = ['January', 'February', 'March', 'April', 'May', 'June', 'July',
+          'August', 'September', 'October', 'November', 'December']
+
+
+class _ThreadedServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class BenchServer(object):
+    """A local stand-in for the three FRB sites and their PDF downloads.
+
+    Every site serves the same synthetic set of filings, in the shape the
+    scrapers expect: Chicago's per-year HTML pages, Atlanta's getYearList and
+    getDocs JSON, and St. Louis's ASP.NET search form with viewstate, pager
+    postbacks and a page size control. PDFs honour Range requests. Each
+    response can be delayed by a fixed latency, and a fraction of them can
+    be answered with HTTP 503 instead.
+    """
+    LOGGER = logging.getLogger('root')
+
+    CHICAGO_PATH = '/chicago/annual_report_of_bank_holding_companies.cfm'
+    ATLANTA_PATH = '/atlanta/reader.cfm'
+    ATLANTA_DOCS = '/atlanta/docs/'
+    STLOUIS_PATH = '/stlouis/'
+    LAST_MODIFIED = 'Mon, 01 Apr 2013 00:00:00 GMT'
+
+    def __init__(self, docs=500, years=5, pdf_size=65536, latency=0.0,
+                 error_rate=0.0, page_sizes=(10, 25, 50, 100), seed=0):
+        self.docs = int(docs)
+        self.pdf_size = max(64, int(pdf_size))
+        self.latency = float(latency)
+        self.error_rate = float(error_rate)
+        self.page_sizes = list(page_sizes)
+        self.last_year = 2013
+        self.years = [str(self.last_year - i) for i in range(max(1, int(years)))]
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+
+        # The same filings back every site
+        self.filings = [self._make_filing(i) for i in range(self.docs)]
+        self._filler = ''.join(chr(32 + (i * 7) % 95) for i in range(4096))
+
+        self._server = None
+        self._thread = None
+
+    def _make_filing(self, i):
+        year = self.years[i % len(self.years)]
+        return {
+            'id': i + 1,
+            'rssd': 1000000 + i,
+            'name': 'Bancorp %d, Inc.' % (i + 1),
+            'city': 'City %d' % (i % 97),
+            'state': 'ST',
+            'year': year,
+            'month': i % 12 + 1,
+            'day': i % 28 + 1,
+            'file': '%d_%s.pdf' % (1000000 + i, year),
+            'atlanta_file': 'FRY6_%d_%s.pdf' % (1000000 + i, year)
+        }
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://%s:%d' % (host, port)
+
+    def start(self, port=0):
+        handler = _make_handler(self)
+        self._server = _ThreadedServer(('127.0.0.1', port), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        BenchServer.LOGGER.info('Benchmark server listening at %s' % self.url)
+        return self
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'errors': self.errors,
+                    'bytes': self.bytes_sent}
+
+    def inject_error(self):
+        with self._lock:
+            self.requests += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+        return False
+
+    def sent(self, size):
+        with self._lock:
+            self.bytes_sent += size
+
+    def filings_for(self, year):
+        return [f for f in self.filings if f['year'] == year]
+
+    # Chicago
+
+    def chicago_page(self, query):
+        year = query.get('DisplayYear') or self.years[0]
+        links = ''.join('<a href="?DisplayYear=%s">%s</a> ' % (y, y) for y in self.years)
+        rows = []
+        for f in self.filings_for(year):
+            rows.append(
+                '<tr><td><label for="File name"><a href="/chicago/docs/%s">%s</a></label></td>'
+                '<td><label for="ID RSSD">%d</label></td>'
+                '<td><label for="Date file was posted">%02d/%02d/%d</label></td></tr>'
+                % (f['file'], f['file'], f['rssd'], f['month'], f['day'], int(year) + 1))
+        return ('<html><body><table><tr><td>Display Data %s</td></tr></table>'
+                '<p><b>Data Displayed for Year %s</b></p>'
+                '<table><tr><th>File name</th><th>ID RSSD</th><th>Date file was posted</th></tr>'
+                '%s</table></body></html>' % (links, year, '\n'.join(rows)))
+
+    # Atlanta
+
+    def atlanta_json(self, query):
+        request = json.loads(urllib.unquote(query))
+        if request.get('reader') == 'getYearList':
+            return json.dumps([int(y) for y in self.years])
+        year = request.get('dataStruct', {}).get('docyear')
+        data = [[f['rssd'], f['name'], f['city'], f['state'], int(f['year']),
+                 '%s, %02d %d 00:00:00' % (MONTHS[f['month'] - 1], f['day'], int(f['year']) + 1),
+                 f['atlanta_file']] for f in self.filings_for(year)]
+        return json.dumps({'COLUMNS': ATL_COLUMNS, 'DATA': data})
+
+    # St. Louis
+
+    def stlouis_page(self, form):
+        page, size = 1, self.page_sizes[0] if self.page_sizes else 10
+        state = form.get('__VIEWSTATE')
+        if state:
+            page, size = [int(v) for v in base64.b64decode(state).split('|')[:2]]
+
+        target = form.get('__EVENTTARGET', '')
+        if target == STL_PAGE_SIZE and form.get(STL_PAGE_SIZE, '').isdigit():
+            page, size = 1, int(form[STL_PAGE_SIZE])
+        elif 'pgrSearchData' in target:
+            page = int(target.rsplit('$ctl', 1)[1])
+
+        pages = max(1, -(-self.docs // size))
+        rows = []
+        for f in self.filings[(page - 1) * size:page * size]:
+            rows.append(
+                '<tr><td>%s</td><td>%s</td><td>%s</td><td>%d</td><td>%s</td>'
+                '<td>%02d/%02d/%d</td><td><a class="previewLink" href="Doc.aspx?id=%d">'
+                'Preview</a></td></tr>' % (f['name'], f['city'], f['state'], f['rssd'],
+                f['year'], f['month'], f['day'], int(f['year']) + 1, f['id']))
+
+        # A block of ten numbered pages, then '...' for the next block
+        start = (page - 1) // 10 * 10 + 1
+        pager = []
+        for p in range(start, min(pages, start + 9) + 1):
+            if p == page:
+                pager.append('<span class="currentSearchPage">%d</span>' % p)
+            else:
+                pager.append('<a href="javascript:__doPostBack(\'%s\',\'\')">%d</a>'
+                    % (STL_PAGER % p, p))
+        if start + 10 <= pages:
+            pager.append('<a href="javascript:__doPostBack(\'%s\',\'\')">...</a>'
+                % (STL_PAGER % (start + 10)))
+
+        select = ''
+        if self.page_sizes:
+            select = '<select name="%s" id="ddlPageSize">%s</select>' % (STL_PAGE_SIZE,
+                ''.join('<option value="%d"%s>%d</option>' % (s,
+                    ' selected="selected"' if s == size else '', s) for s in self.page_sizes))
+
+        # Real viewstate runs to kilobytes; pad it so postbacks weigh as much
+        viewstate = base64.b64encode('%d|%d|%s' % (page, size, self._filler[:3000]))
+        return ('<html><body><form method="post" action="./">'
+                '<input type="hidden" name="__VIEWSTATE" value="%s" />'
+                '<input type="hidden" name="__EVENTVALIDATION" value="%s" />'
+                '<input type="hidden" name="__EVENTTARGET" value="" />'
+                '<input type="hidden" name="__EVENTARGUMENT" value="" />%s'
+                '<table><tr>%s</tr>%s</table>'
+                '<div id="searchResultsPager"><span>%s</span></div>'
+                '</form></body></html>' % (viewstate, base64.b64encode(self._filler[:400]),
+                select, ''.join('<th>%s</th>' % h for h in STL_HEADERS),
+                '\n'.join(rows), ''.join(pager)))
+
+    # Downloads
+
+    def pdf_body(self, name):
+        head = '%%PDF-1.4\n%% %s\n' % name
+        tail = '\n%%EOF\n'
+        size = self.pdf_size - len(head) - len(tail)
+        body = (self._filler * (size // len(self._filler) + 1))[:size]
+        return head + body + tail
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Headers and body go out in separate writes
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            self._route('GET')
+
+        def do_HEAD(self):
+            self._route('HEAD')
+
+        def do_POST(self):
+            self._route('POST')
+
+        def _route(self, method):
+            length = int(self.headers.get('content-length') or 0)
+            body = self.rfile.read(length) if length else ''
+
+            if server.latency:
+                time.sleep(server.latency)
+            if server.inject_error():
+                return self._send(503, 'Service Unavailable', 'text/plain')
+
+            parts = urlparse(self.path)
+            path = parts.path
+            if path == BenchServer.CHICAGO_PATH:
+                self._send(200, server.chicago_page(dict(parse_qsl(parts.query))))
+            elif path == BenchServer.ATLANTA_PATH:
+                self._send(200, server.atlanta_json(parts.query), 'application/json')
+            elif path == BenchServer.STLOUIS_PATH and method == 'POST':
+                self._send(200, server.stlouis_page(dict(parse_qsl(body))))
+            elif path.endswith('.pdf') or path.endswith('Doc.aspx'):
+                self._send_pdf(server.pdf_body(self.path.split('/')[-1]), method)
+            else:
+                self._send(404, 'Not Found', 'text/plain')
+
+        def _send_pdf(self, body, method):
+            total = len(body)
+            etag = '"%x-%x"' % (hash(body) & 0xffffffff, total)
+            start = 0
+            byte_range = self.headers.get('range', '')
+            if_range = self.headers.get('if-range')
+            # A stale If-Range gets the whole file
+            if if_range and if_range not in (etag, BenchServer.LAST_MODIFIED):
+                byte_range = ''
+            if byte_range.startswith('bytes='):
+                try:
+                    start = int(byte_range[6:].split('-')[0])
+                except ValueError:
+                    start = 0
+                if start >= total:
+                    self.send_response(416)
+                    self.send_header('Content-Range', 'bytes */%d' % total)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+            self.send_response(206 if start else 200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(total - start))
+            self.send_header('ETag', etag)
+            self.send_header('Last-Modified', BenchServer.LAST_MODIFIED)
+            if start:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, total - 1, total))
+            self.end_headers()
+            if method != 'HEAD':
+                self.wfile.write(body[start:])
+                server.sent(total - start)
+
+        def _send(self, status, body, content_type='text/html; charset=utf-8'):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+                server.sent(len(body))
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
@@ -1,8 +1,21 @@
 from bankhandler import FRB
+from document import Document
+from fetchpool import FetchPool
+from httpcache import HTTPCache
 import requests
 import logging
-import lxml.html
 import urlparse
+from itertools import izip
+import parsing
+from lxml import etree
+
+# The years listed in the first <td> that reads 'Display Data'
+YEAR_LINKS = etree.XPath('(//td[contains(text(), "Display Data")])[1]/*')
+CURRENT_YEAR = etree.XPath('//b[contains(text(), "Data Displayed for Year")]/text()')
+# Rows whose first cell holds a <label> for one of the file columns
+FILE_ROWS = etree.XPath(
+    '//tr[*[1][self::td]/*[1][self::label]'
+    '[@for="File name" or @for="ID RSSD" or @for="Date file was posted"]]')
 
 class Chicago(FRB):
     """ Contains all the FR-Y6 filing data scraped from the Chicago FRB."""
@@ -13,71 +26,69 @@ class Chicago(FRB):
     DATE_FORMAT = ('%m/%d/%Y')
     BANK_CODE = 'C'
 
-    def __init__(self):
-        super(Chicago, self).__init__()
+    def __init__(self, run=True):
         self.years = None
         self.first_year = None
+        super(Chicago, self).__init__(run)
 
-    def scrape(self):
+    def iter_pages(self):
         # Request the first page
-        html = self._request_html()
+        resp = self._request_html()
+        if not(resp):
+            return
 
-        # Get the list of years
-        self._get_page_years(html)
+        # Get the list of years. The tree is reused when parsing the files.
+        self._get_page_years(parsing.html_tree(resp))
 
         # Given years, parse the file listings for each year
-        self._get_files(html)
+        for page_files in self._get_files(resp):
+            yield page_files
 
     def _request_html(self, payload=dict()):
         self.logger.info("Beginning scrape of chicagofed.org")
-        # Get the raw HTML
-        tries = 0
-        while tries <= 5:
-            self.logger.info("Please wait. Loading %s... " % Chicago.URL),
-            r = requests.get(Chicago.URL, params=payload)
-            r.close()
-            tries += 1
-            if r.status_code == requests.codes.ok:
-                self.logger.info("DONE")
-                return r.text
-            else:
-                self.logger.info("No response. Retrying (%d/5)" % (tries+1))
-        self.logger.warning("No response after 5 attempts.")
-
-    def _get_page_years(self, html):
-        tree = lxml.html.fromstring(html)
+        # Get the raw HTML. HTTPClient retries failures with backoff.
+        self.logger.info("Please wait. Loading %s... " % Chicago.URL)
+        try:
+            r = HTTPCache.request('GET', Chicago.URL, params=payload)
+        except requests.RequestException as e:
+            self.logger.warning("No response: %s" % e)
+            return
+        if r.status_code == requests.codes.ok:
+            self.logger.info("DONE")
+            return r
+        self.logger.warning("No response (HTTP %d)" % r.status_code)
+
+    def _get_page_years(self, tree):
         self._parse_years(tree)
         self._parse_current_year(tree)
 
     def _parse_years(self, tree):
-        # Get all td elements with text
-        all_tds = [e for e in tree.iter(tag='td') if e.text]
-
-        # Single out the td element that includes the text 'Display Data'
-        years_td = [e for e in all_tds if 'Display Data' in e.text][0]
-
         # Grab the year text in each of the a (a href) elements
-        self.years = [a.text for a in list(years_td)]
+        self.years = [a.text for a in YEAR_LINKS(tree)]
 
     def _parse_current_year(self, tree):
         # Find the element that includes the phrase 'Data Displayed for Year'
-        year_element = [e for e in tree.iter(tag='b') if 'Data Displayed for Year' in e.text]
-        self.first_year = year_element[0].text[-4:]
+        self.first_year = CURRENT_YEAR(tree)[0][-4:]
 
-    def _get_files(self, html):
+    def _get_files(self, resp):
         # Parse the documents from the first page's HTML
-        self._parse_files(html, self.first_year)
-        
-        if self.documents:
-            self.table_headers = list(self.documents[0])
+        page_files = self._parse_files(resp, self.first_year)
+        if page_files:
+            yield page_files
 
         # Exclude first year from the remaining years to request
         remaining_years = [y for y in self.years if y != self.first_year]
-
-        # Request a new page for each year, and parse its files
-        for year in remaining_years:
-            html = self._request_year_page(year)
-            self._parse_files(html, year)
+        remaining_years = self._filter_years(remaining_years)
+
+        # Request a page for each year concurrently, and parse its files
+        # in year order
+        pages = FetchPool.imap(self._request_year_page, remaining_years,
+            lambda year: Chicago.URL)
+        for year, resp in izip(remaining_years, pages):
+            if resp:
+                page_files = self._parse_files(resp, year)
+                if page_files:
+                    yield page_files
 
     def _request_year_page(self, year):
         payload = {
@@ -87,52 +98,44 @@ class Chicago(FRB):
         'DisplayYear': year
         }
 
-        html = self._request_html(payload)
-        return html
+        return self._request_html(payload)
 
-    def _parse_files(self, html, year):
-        # Get the list of files from the HTML
-        tree = lxml.html.fromstring(html)
-        page_files = self._parse_list(tree)
+    def _parse_files(self, resp, year):
+        # Get the list of files from the HTML, unless this exact page was
+        # parsed on an earlier run
+        rows = HTTPCache.parsed(resp,
+            lambda r: self._parse_list(parsing.html_tree(r)))
 
-        # Include the Year with the file data
-        for row in page_files:
-            row['Report Year'] = year
+        # The listing has no year column; each page covers one year
+        page_files = [Document(row.get('ID RSSD'), row.get('File name'),
+                               row.get('Date file was posted'), year, row.get('URL'),
+                               Chicago.BANK_CODE) for row in rows]
 
         # Report on the results
         if page_files:
             self.logger.info("Found %d files covering %s" % (len(page_files), year))
-            # Append the new documents
-            self.documents += page_files
         else:
             self.logger.warning("No files parsed for %s from %s" % (year, Chicago.URL))
+        return page_files
 
     def _parse_list(self, tree):
-        valid_for_label = ['File name', 'ID RSSD', 'Date file was posted']
-
-        # Harvest TR elements that contain file data.
-        all_trs = [e for e in tree.iter(tag='tr')]
-        # Relevant TRs have TD child, with a valid 'for' attribute (in valid_for_label)
-        doc_trs = [e for e in all_trs if list(e)[0].tag == 'td'  # TR child
-                   and list(list(e)[0])[0].tag == 'label'  # TR grandchild
-                   and list(list(e)[0])[0].attrib['for'] in valid_for_label]
-
-        # Reconstitute this table as a list of dicts
+        # Reconstitute this table as a list of dicts, in a single pass over
+        # the matching rows
         file_list = []
-        for tr in doc_trs:
+        for tr in FILE_ROWS(tree):
             one_row = {}
             # Compose a dict for each row
             for td in tr:
-                td_label = list(td)[0]  # The first TD child element should be a label.
+                td_label = td[0]  # The first TD child element should be a label.
                 if td_label.text:
-                    one_row[td_label.attrib['for']] = td_label.text
+                    one_row[td_label.get('for')] = td_label.text
                 else:
                     # When it doesn't have text, then <label>'s first child is <a>
                     # When <label> has a child, text is inside that element.
-                    td_a = list(td_label)[0]
-                    abs_url = urlparse.urljoin(Chicago.URL, td_a.attrib['href'])
+                    td_a = td_label[0]
+                    abs_url = urlparse.urljoin(Chicago.URL, td_a.get('href'))
                     one_row['URL'] = abs_url
-                    one_row[td_label.attrib['for']] = td_a.text
+                    one_row[td_label.get('for')] = td_a.text
             file_list.append(one_row)
 
-        return file_list
\ No newline at end of file
+        return file_list
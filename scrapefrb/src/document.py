@@ -0,0 +1,31 @@
+class Document(object):
+    """One FR Y-6 filing, as produced by every scraper.
+
+    rssd and year are integers whenever the site's text is numeric. date
+    holds the site's text until the bank's Normalizer turns it into an ISO
+    'YYYY-MM-DD' string.
+    """
+    __slots__ = ('rssd', 'name', 'date', 'year', 'url', 'bank_code')
+
+    def __init__(self, rssd, name, date, year, url, bank_code=None):
+        self.rssd = _to_int(rssd)
+        self.name = name
+        self.date = date
+        self.year = _to_int(year)
+        self.url = url
+        self.bank_code = bank_code
+
+    def key(self):
+        # The identity stored in fry6: UNIQUE (rssd_id, year, company)
+        return (self.rssd, self.name, self.year)
+
+    def __repr__(self):
+        return 'Document(%r, %r, %r, %r, %r, %r)' % (self.rssd, self.name,
+            self.date, self.year, self.url, self.bank_code)
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
@@ -0,0 +1,177 @@
+import csv
+from collections import OrderedDict
+import json
+import logging
+import os
+import time
+from frblogger import replace_file
+from query import COLUMNS
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+class Exporter(object):
+    """Streams the rows matched by a DocumentQuery into a CSV, JSONL or
+    Parquet file, BATCH_SIZE rows at a time, so memory use stays flat as the
+    table grows.
+
+    An incremental export writes only the rows stored since the last
+    incremental export to the same file, tracked by doc_id in STATE_FILE.
+    Each run that finds new rows writes its own file, named with the last
+    doc_id it holds (frb_export.1234.csv), so earlier exports are kept.
+    The output is written to a temporary file and renamed into place, so a
+    failed export leaves the previous file and state untouched.
+    """
+    LOGGER = logging.getLogger('root')
+
+    FORMATS = ['csv', 'jsonl', 'parquet']
+    BATCH_SIZE = 1000
+    STATE_FILE = 'frb_export_state.json'
+
+    @classmethod
+    def set_working_path(cls, path):
+        cls.STATE_FILE = os.path.join(path, cls.STATE_FILE)
+
+    @classmethod
+    def set_batch_size(cls, size):
+        cls.BATCH_SIZE = max(1, int(size))
+
+    def __init__(self, db, document_query, file_name, file_format='csv'):
+        if file_format not in Exporter.FORMATS:
+            raise ValueError('Unknown export format: %s' % file_format)
+        if file_format == 'parquet' and pyarrow is None:
+            raise ValueError('Parquet export requires pyarrow')
+        self.db = db
+        self.query = document_query
+        self.file_name = os.path.abspath(file_name)
+        self.format = file_format
+
+    def run(self, incremental=False):
+        """Write the export and return (rows written, last doc_id)."""
+        state = self._read_state() if incremental else {}
+        if incremental and state.get(self.file_name):
+            self.query.after_id = max(self.query.after_id or 0, state[self.file_name])
+
+        start = time.time()
+        temp_name = self.file_name + '.tmp'
+        writer = getattr(self, '_write_' + self.format)
+        try:
+            count, last_id = writer(temp_name, self._batches())
+        except:
+            _remove(temp_name)
+            raise
+
+        if incremental and not(count):
+            # Nothing new; the previous exports and state stay as they are
+            _remove(temp_name)
+            Exporter.LOGGER.info('No filings stored since the last export to %s'
+                % self.file_name)
+            return count, last_id
+
+        file_name = self.incremental_name(last_id) if incremental else self.file_name
+        replace_file(temp_name, file_name)
+
+        if incremental:
+            # Only advanced once the rows are safely in place
+            state[self.file_name] = last_id
+            self._write_state(state)
+
+        diff = time.time() - start
+        Exporter.LOGGER.info('Exported %d rows to %s in %0.2f seconds'
+            % (count, file_name, diff))
+        return count, last_id
+
+    def incremental_name(self, last_id):
+        # frb_export.csv -> frb_export.<last doc_id>.csv
+        root, ext = os.path.splitext(self.file_name)
+        return '%s.%d%s' % (root, last_id, ext)
+
+    def _batches(self):
+        # A dedicated cursor steps through the result set in place; only one
+        # batch of rows is ever held in memory
+        statement, params = self.query.sql(self.db)
+        cursor = self.db.conn.cursor()
+        try:
+            cursor.execute(statement, params)
+            while True:
+                rows = cursor.fetchmany(Exporter.BATCH_SIZE)
+                if not(rows):
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def _write_csv(self, file_name, batches):
+        count, last_id = 0, None
+        with open(file_name, 'wb') as outfile:
+            writer = csv.writer(outfile)
+            writer.writerow(COLUMNS)
+            for rows in batches:
+                writer.writerows([[_utf8(v) for v in row] for row in rows])
+                count += len(rows)
+                last_id = rows[-1][0]
+        return count, last_id
+
+    def _write_jsonl(self, file_name, batches):
+        count, last_id = 0, None
+        with open(file_name, 'wb') as outfile:
+            for rows in batches:
+                outfile.write(''.join(json.dumps(OrderedDict(zip(COLUMNS, row))) + '\n'
+                                      for row in rows))
+                count += len(rows)
+                last_id = rows[-1][0]
+        return count, last_id
+
+    def _write_parquet(self, file_name, batches):
+        schema = pyarrow.schema([
+            ('doc_id', pyarrow.int64()), ('rssd_id', pyarrow.int64()),
+            ('company', pyarrow.string()), ('date', pyarrow.string()),
+            ('year', pyarrow.int64()), ('url', pyarrow.string()),
+            ('insert_date', pyarrow.string()), ('frb_code', pyarrow.string())])
+        count, last_id = 0, None
+        writer = pyarrow.parquet.ParquetWriter(file_name, schema)
+        try:
+            for rows in batches:
+                # Each batch becomes one row group
+                columns = zip(*rows)
+                arrays = [pyarrow.array([_text(v) for v in column]
+                          if field.type == pyarrow.string() else list(column), field.type)
+                          for field, column in zip(schema, columns)]
+                writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+                count += len(rows)
+                last_id = rows[-1][0]
+        finally:
+            writer.close()
+        return count, last_id
+
+    def _read_state(self):
+        try:
+            with open(Exporter.STATE_FILE) as infile:
+                return json.load(infile)
+        except (IOError, ValueError):
+            return {}
+
+    def _write_state(self, state):
+        with open(Exporter.STATE_FILE, 'w') as outfile:
+            json.dump(state, outfile, indent=2, sort_keys=True)
+
+
+def _remove(file_name):
+    if os.path.exists(file_name):
+        os.remove(file_name)
+
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+
+def _text(value):
+    if value is None or isinstance(value, basestring):
+        return value
+    return unicode(value)
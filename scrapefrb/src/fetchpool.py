@@ -0,0 +1,73 @@
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+from urlparse import urlparse
+
+
+class FetchPool(object):
+    """Runs independent requests on a bounded thread pool.
+
+    Every call is throttled by a per-host semaphore, so no single site sees
+    more than HOST_LIMIT requests in flight, regardless of how many banks or
+    pools are running at the same time.
+    """
+    LOGGER = logging.getLogger('root')
+
+    HOST_LIMIT = 4
+
+    _host_slots = {}
+    _slots_lock = threading.Lock()
+
+    @classmethod
+    def set_host_limit(cls, limit):
+        with cls._slots_lock:
+            cls.HOST_LIMIT = max(1, int(limit))
+            cls._host_slots = {}
+
+    @classmethod
+    def host_slot(cls, url):
+        # One semaphore per host name, shared by every pool in the process
+        host = urlparse(url).netloc.lower()
+        with cls._slots_lock:
+            slot = cls._host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(cls.HOST_LIMIT)
+                cls._host_slots[host] = slot
+        return slot
+
+    @classmethod
+    def map(cls, func, items, url_func, workers=None):
+        """Call func(item) for each item and return the results in item order.
+
+        url_func(item) names the URL the call will hit, which selects the
+        per-host slot.
+        """
+        return list(cls.imap(func, items, url_func, workers))
+
+    @classmethod
+    def imap(cls, func, items, url_func, workers=None):
+        """Like map, but yield each result, in item order, as soon as it and
+        every result before it are available.
+        """
+        items = list(items)
+        if not items:
+            return
+
+        def fetch(item):
+            with cls.host_slot(url_func(item)):
+                return func(item)
+
+        workers = min(workers or cls.HOST_LIMIT, len(items))
+        if workers <= 1:
+            for item in items:
+                yield fetch(item)
+            return
+
+        pool = ThreadPool(workers)
+        try:
+            # ThreadPool.imap preserves the input order
+            for result in pool.imap(fetch, items):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
@@ -1,3 +1,4 @@
+import json
 import os.path
 import logging
 import logging.handlers
@@ -24,4 +25,18 @@ def configure_logger(name, path):
     logger.addHandler(fh)
     logger.addHandler(ch)
     logger.setLevel(logging.DEBUG)
-    return logger
\ No newline at end of file
+    return logger
+
+def replace_file(temp_name, file_name):
+    # Move a finished temporary file over file_name. os.rename replaces the
+    # target atomically on POSIX; Windows refuses to rename over a file.
+    if os.name == 'nt' and os.path.exists(file_name):
+        os.remove(file_name)
+    os.rename(temp_name, file_name)
+
+def write_report(path, report, name='frb_report.json'):
+    # Machine-readable summary of the last run, next to frb.log
+    file_name = os.path.join(path, name)
+    with open(file_name, 'w') as outfile:
+        json.dump(report, outfile, indent=2, sort_keys=True)
+    return file_name
@@ -0,0 +1,244 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from requests.structures import CaseInsensitiveDict
+from archive import ResponseArchive
+from httpclient import HTTPClient
+from metrics import Metrics
+
+
+class CachedResponse(object):
+    """The parts of a requests.Response the scrapers use, backed either by
+    a live response or by the body stored in the HTTPCache.
+    """
+
+    def __init__(self, url, status_code, content, encoding=None, headers=None,
+                 cache_key=None, from_cache=False):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.encoding = encoding or 'utf-8'
+        self.headers = headers or {}
+        self.cache_key = cache_key
+        # True when the server answered 304 and the stored body was reused
+        self.from_cache = from_cache
+        self.body_hash = hashlib.sha1(content).hexdigest()
+
+    @property
+    def ok(self):
+        return 200 <= self.status_code < 400
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding, 'replace')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def close(self):
+        pass
+
+
+class HTTPCache(object):
+    """Persistent validator cache for listing pages.
+
+    Responses are stored in FILE_NAME keyed by method, URL and request
+    payload, along with their ETag and Last-Modified headers. Later requests
+    for the same key are sent conditionally, and a 304 reply reuses the
+    stored body. The result of parsing a body can be stored too, so an
+    unchanged body is not parsed again.
+
+    Only GETs are cached. The St. Louis POSTs carry a fresh __VIEWSTATE in
+    their payload, so their keys would never be requested again. Entries
+    the server has not sent or confirmed for MAX_AGE seconds are pruned
+    when the cache is opened.
+    """
+    LOGGER = logging.getLogger('root')
+
+    FILE_NAME = 'frb_cache.db'
+    ENABLED = True
+    # Bump whenever a scraper changes the shape of what it stores through
+    # parsed(), so results in the old shape are not reused
+    PARSE_VERSION = 2
+    CACHED_METHODS = ('GET',)
+    MAX_AGE = 30 * 24 * 3600
+
+    TABLE = 'responses'
+
+    CREATE_STATEMENT = ('''
+        CREATE TABLE IF NOT EXISTS %s
+        (cache_key text PRIMARY KEY,
+        url text,
+        etag text,
+        last_modified text,
+        encoding text,
+        body blob,
+        body_hash text,
+        parsed text,
+        parsed_hash text,
+        fetch_date real)
+        ''' % (TABLE)
+    )
+
+    _conn = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def set_working_path(cls, path):
+        cls.FILE_NAME = os.path.join(path, cls.FILE_NAME)
+
+    @classmethod
+    def set_enabled(cls, enabled):
+        cls.ENABLED = enabled
+
+    @classmethod
+    def _connection(cls):
+        if cls._conn is None:
+            cls._conn = sqlite3.connect(cls.FILE_NAME, check_same_thread=False)
+            cls._conn.text_factory = str
+            cls._conn.execute(cls.CREATE_STATEMENT)
+            pruned = cls._conn.execute('DELETE FROM %s WHERE fetch_date < ?' % cls.TABLE,
+                (time.time() - cls.MAX_AGE,)).rowcount
+            cls._conn.commit()
+            if pruned:
+                cls.LOGGER.info('Pruned %d stale entries from the HTTP cache' % pruned)
+        return cls._conn
+
+    @classmethod
+    def make_key(cls, method, url, params=None, data=None):
+        parts = [method.upper(), url]
+        for payload in (params, data):
+            if payload:
+                parts.append(json.dumps(sorted(payload.items())))
+            else:
+                parts.append('')
+        key = '\n'.join(parts)
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return hashlib.sha1(key).hexdigest()
+
+    @classmethod
+    def request(cls, method, url, params=None, data=None, headers=None):
+        """Send a request through HTTPClient, conditionally when a cached
+        copy exists. Always returns a CachedResponse.
+        """
+        with Metrics.timer(Metrics.label(url), 'fetch'):
+            if ResponseArchive.REPLAY:
+                return cls._replay(method, url, params, data)
+            resp = cls._request(method, url, params, data, dict(headers or {}))
+            if ResponseArchive.RECORD:
+                ResponseArchive.record(cls.make_key(method, url, params, data),
+                    method, url, params, data, resp)
+            return resp
+
+    @classmethod
+    def _replay(cls, method, url, params, data):
+        # Answer from the response archive, never the network
+        entry = ResponseArchive.lookup(cls.make_key(method, url, params, data))
+        if entry is None:
+            cls.LOGGER.warning('Not in the archive: %s %s' % (method, url))
+            Metrics.incr(Metrics.label(url), 'replay_misses')
+            return CachedResponse(url, 404, '')
+        # No cache_key, so a replayed page is always parsed again
+        return CachedResponse(entry['final_url'], entry['status'],
+            ResponseArchive.body(entry), entry['encoding'],
+            CaseInsensitiveDict(entry['headers']))
+
+    @classmethod
+    def _request(cls, method, url, params, data, headers):
+        label = Metrics.label(url)
+
+        if not(cls.ENABLED) or method.upper() not in cls.CACHED_METHODS:
+            r = HTTPClient.request(method, url, params=params, data=data, headers=headers)
+            Metrics.incr(label, 'bytes', len(r.content))
+            return cls._wrap(r)
+
+        key = cls.make_key(method, url, params, data)
+        with cls._lock:
+            cached = cls._connection().execute(
+                'SELECT etag, last_modified, encoding, body FROM %s WHERE cache_key = ?'
+                % cls.TABLE, (key,)).fetchone()
+
+        if cached:
+            etag, last_modified = cached[0], cached[1]
+            if etag:
+                headers['If-None-Match'] = etag
+            if last_modified:
+                headers['If-Modified-Since'] = last_modified
+
+        r = HTTPClient.request(method, url, params=params, data=data, headers=headers)
+
+        if r.status_code == 304 and cached:
+            r.close()
+            cls.LOGGER.debug('Not modified, using cached copy of %s' % url)
+            Metrics.incr(label, 'cache_hits')
+            with cls._lock:
+                conn = cls._connection()
+                # Confirmed current, so not pruned
+                conn.execute('UPDATE %s SET fetch_date = ? WHERE cache_key = ?'
+                    % cls.TABLE, (time.time(), key))
+                conn.commit()
+            return CachedResponse(r.url, 200, str(cached[3]), cached[2],
+                r.headers, key, from_cache=True)
+
+        resp = cls._wrap(r, key)
+        Metrics.incr(label, 'bytes', len(resp.content))
+        if resp.ok:
+            cls._store(resp, r.headers)
+        return resp
+
+    @classmethod
+    def parsed(cls, resp, parse_func):
+        """Return parse_func(resp), reusing the stored result when this body
+        has been parsed before. Results must be JSON serializable.
+        """
+        label = Metrics.label(resp.url)
+        if not(cls.ENABLED) or not(getattr(resp, 'cache_key', None)):
+            with Metrics.timer(label, 'parse'):
+                return parse_func(resp)
+
+        with cls._lock:
+            row = cls._connection().execute(
+                'SELECT parsed, parsed_hash FROM %s WHERE cache_key = ?'
+                % cls.TABLE, (resp.cache_key,)).fetchone()
+        parsed_hash = '%s:%d' % (resp.body_hash, cls.PARSE_VERSION)
+        if row and row[0] is not None and row[1] == parsed_hash:
+            Metrics.incr(label, 'parse_cache_hits')
+            return json.loads(row[0])
+
+        with Metrics.timer(label, 'parse'):
+            result = parse_func(resp)
+        with cls._lock:
+            conn = cls._connection()
+            conn.execute('UPDATE %s SET parsed = ?, parsed_hash = ? WHERE cache_key = ?'
+                % cls.TABLE, (json.dumps(result), parsed_hash, resp.cache_key))
+            conn.commit()
+        return result
+
+    @classmethod
+    def _wrap(cls, r, key=None):
+        return CachedResponse(r.url, r.status_code, r.content,
+            r.encoding or r.apparent_encoding, r.headers, key)
+
+    @classmethod
+    def _store(cls, resp, headers):
+        record = (resp.cache_key, resp.url, headers.get('etag'),
+                  headers.get('last-modified'), resp.encoding,
+                  sqlite3.Binary(resp.content), resp.body_hash, time.time())
+        with cls._lock:
+            conn = cls._connection()
+            # Keep a previous parse result if the body did not change
+            conn.execute('''
+                INSERT OR REPLACE INTO %s
+                (cache_key, url, etag, last_modified, encoding, body, body_hash,
+                 parsed, parsed_hash, fetch_date)
+                VALUES (?, ?, ?, ?, ?, ?, ?,
+                    (SELECT parsed FROM %s WHERE cache_key = ?),
+                    (SELECT parsed_hash FROM %s WHERE cache_key = ?), ?)
+                ''' % (cls.TABLE, cls.TABLE, cls.TABLE),
+                record[:7] + (resp.cache_key, resp.cache_key) + record[7:])
+            conn.commit()
@@ -0,0 +1,113 @@
+import logging
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from fetchpool import FetchPool
+from metrics import Metrics
+from ratelimit import RateLimiter
+
+
+class HTTPClient(object):
+    """The one HTTP session shared by every scraper and the downloader.
+
+    Connections are kept alive in per-host pools sized to the FetchPool
+    host limit. Every request is paced by the host's RateLimiter and gets
+    connect/read timeouts. 429 and 5xx replies, connection errors and
+    timeouts are retried with exponential backoff plus jitter.
+    """
+    LOGGER = logging.getLogger('root')
+
+    CONNECT_TIMEOUT = 10
+    READ_TIMEOUT = 60
+    RETRIES = 4
+    BACKOFF = 0.5  # seconds before the first retry, doubled after each
+    BACKOFF_MAX = 30
+
+    _session = None
+    _lock = threading.Lock()
+
+    @classmethod
+    def set_timeout(cls, read_timeout):
+        cls.READ_TIMEOUT = float(read_timeout)
+
+    @classmethod
+    def set_retries(cls, retries):
+        cls.RETRIES = max(0, int(retries))
+
+    @classmethod
+    def session(cls):
+        with cls._lock:
+            if cls._session is None:
+                s = requests.Session()
+                adapter = HTTPAdapter(pool_connections=8,
+                    pool_maxsize=FetchPool.HOST_LIMIT)
+                s.mount('http://', adapter)
+                s.mount('https://', adapter)
+                cls._session = s
+            return cls._session
+
+    @classmethod
+    def close(cls):
+        # Drop every pooled connection; the next request opens a new session
+        with cls._lock:
+            if cls._session is not None:
+                cls._session.close()
+                cls._session = None
+
+    @classmethod
+    def request(cls, method, url, **kwargs):
+        """Send a request through the shared session, retrying failures.
+
+        Returns the final response, which may still be a 429 or 5xx once
+        the retries are used up. Raises requests.RequestException when the
+        last attempt could not connect or timed out.
+        """
+        kwargs.setdefault('timeout', (cls.CONNECT_TIMEOUT, cls.READ_TIMEOUT))
+        session = cls.session()
+
+        label = Metrics.label(url)
+        attempt = 0
+        while True:
+            waited = RateLimiter.acquire(url, session)
+            if waited:
+                Metrics.add_time(label, 'throttle', waited)
+            Metrics.incr(label, 'requests')
+            try:
+                r = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if RateLimiter.feedback(url):
+                    Metrics.incr(label, 'rate_cuts')
+                if attempt >= cls.RETRIES:
+                    Metrics.incr(label, 'request_errors')
+                    raise
+                cls._wait(attempt, method, url, e)
+            else:
+                if RateLimiter.feedback(url, r.elapsed.total_seconds(), r.status_code,
+                                        r.headers.get('retry-after')):
+                    Metrics.incr(label, 'rate_cuts')
+                if (r.status_code < 500 and r.status_code != 429) or attempt >= cls.RETRIES:
+                    return r
+                r.close()
+                cls._wait(attempt, method, url, 'HTTP %d' % r.status_code)
+            attempt += 1
+
+    @classmethod
+    def get(cls, url, **kwargs):
+        return cls.request('GET', url, **kwargs)
+
+    @classmethod
+    def head(cls, url, **kwargs):
+        return cls.request('HEAD', url, **kwargs)
+
+    @classmethod
+    def _wait(cls, attempt, method, url, reason):
+        # Full jitter: anywhere up to the exponential backoff ceiling. A
+        # Retry-After delay is enforced by RateLimiter on top of this.
+        ceiling = min(cls.BACKOFF_MAX, cls.BACKOFF * (2 ** attempt))
+        delay = random.uniform(0, ceiling)
+        Metrics.incr(Metrics.label(url), 'retries')
+        cls.LOGGER.info('%s %s failed (%s). Retry %d/%d in %0.1f seconds'
+            % (method, url, reason, attempt + 1, cls.RETRIES, delay))
+        time.sleep(delay)
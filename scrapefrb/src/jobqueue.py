@@ -0,0 +1,285 @@
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+
+
+class DownloadQueue(object):
+    """Download jobs shared by any number of `scrapefrb worker` processes,
+    stored in the download_jobs table of frb_files.db.
+
+    A worker claims a batch of jobs by leasing them for LEASE_SECONDS, and
+    renews the lease with a heartbeat while it downloads. A job whose lease
+    runs out (its worker died or hung) can be claimed again. A failed job
+    is retried after an exponential delay. Either way a job gets at most
+    MAX_ATTEMPTS attempts.
+
+    Claims run in an immediate transaction, so two workers never lease the
+    same job. Workers on other machines need the workpath on a shared
+    filesystem with working file locks.
+    """
+    LOGGER = logging.getLogger('root')
+
+    # The table lives next to the manifest, in frb_files.db
+    FILE_NAME = 'frb_files.db'
+    TABLE = 'download_jobs'
+    LEASE_SECONDS = 300
+    MAX_ATTEMPTS = 5
+    RETRY_DELAY = 60
+    BUSY_TIMEOUT = 60
+
+    CREATE_STATEMENT = ('''
+        CREATE TABLE IF NOT EXISTS %s
+        (url text PRIMARY KEY,
+        file_name text,
+        changed integer DEFAULT 0,
+        state text DEFAULT 'pending',
+        attempts integer DEFAULT 0,
+        not_before real DEFAULT 0,
+        lease_owner text,
+        lease_expires real,
+        heartbeat real,
+        last_error text,
+        enqueued real,
+        finished real)
+        ''' % (TABLE)
+    )
+
+    INDEX_STATEMENT = ('CREATE INDEX IF NOT EXISTS %s_state ON %s (state, not_before)'
+        % (TABLE, TABLE))
+
+    _conn = None
+    _lock = threading.RLock()
+
+    @classmethod
+    def set_working_path(cls, path):
+        cls.FILE_NAME = os.path.join(path, cls.FILE_NAME)
+
+    @classmethod
+    def set_lease(cls, seconds):
+        cls.LEASE_SECONDS = max(10, int(seconds))
+
+    @classmethod
+    def _connection(cls):
+        # Autocommit, so each method controls its own transaction
+        if cls._conn is None:
+            cls._conn = sqlite3.connect(cls.FILE_NAME, timeout=cls.BUSY_TIMEOUT,
+                isolation_level=None, check_same_thread=False)
+            cls._conn.execute(cls.CREATE_STATEMENT)
+            cls._conn.execute(cls.INDEX_STATEMENT)
+        return cls._conn
+
+    @classmethod
+    def close(cls):
+        with cls._lock:
+            if cls._conn is not None:
+                cls._conn.close()
+                cls._conn = None
+
+    @staticmethod
+    def make_owner():
+        return '%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+    @classmethod
+    def enqueue(cls, files):
+        """Queue files (dicts of 'URL', 'File Name' and optional 'Changed'
+        from FRBDownload.compare_local). A URL that is already queued or
+        leased is left alone; a finished or failed one is queued again.
+        Returns the number of jobs queued.
+        """
+        now = time.time()
+        rows = [(f['URL'], f['File Name'], int(bool(f.get('Changed'))), now) for f in files]
+        with cls._lock:
+            conn = cls._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                before = conn.total_changes
+                conn.executemany('''
+                    INSERT OR IGNORE INTO %s (url, file_name, changed, enqueued)
+                    VALUES (?, ?, ?, ?)''' % cls.TABLE, rows)
+                conn.executemany('''
+                    UPDATE %s SET state = 'pending', attempts = 0, not_before = 0,
+                    changed = ?, last_error = NULL, enqueued = ?
+                    WHERE url = ? AND state IN ('done', 'failed')''' % cls.TABLE,
+                    [(changed, enqueued, url) for url, name, changed, enqueued in rows])
+                queued = conn.total_changes - before
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+        DownloadQueue.LOGGER.info('Queued %d download jobs' % queued)
+        return queued
+
+    @classmethod
+    def claim(cls, owner, limit):
+        """Lease up to limit runnable jobs to owner, including jobs whose
+        lease expired. A job whose lease ran out MAX_ATTEMPTS times (its
+        download keeps crashing or hanging the worker) fails instead.
+        Returns the leased jobs as FRBDownload file dicts.
+        """
+        now = time.time()
+        with cls._lock:
+            conn = cls._connection()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                abandoned = conn.execute('''
+                    UPDATE %s SET state = 'failed', finished = ?,
+                    last_error = 'Lease expired after ' || attempts || ' attempts'
+                    WHERE state = 'leased' AND lease_expires < ? AND attempts >= ?'''
+                    % cls.TABLE, (now, now, cls.MAX_ATTEMPTS)).rowcount
+                rows = conn.execute('''
+                    SELECT url, file_name, changed, state FROM %s
+                    WHERE (state = 'pending' AND not_before <= ?)
+                    OR (state = 'leased' AND lease_expires < ?)
+                    ORDER BY enqueued LIMIT ?''' % cls.TABLE, (now, now, limit)).fetchall()
+                conn.executemany('''
+                    UPDATE %s SET state = 'leased', lease_owner = ?, lease_expires = ?,
+                    heartbeat = ?, attempts = attempts + 1 WHERE url = ?''' % cls.TABLE,
+                    [(owner, now + cls.LEASE_SECONDS, now, row[0]) for row in rows])
+                conn.execute('COMMIT')
+            except:
+                conn.execute('ROLLBACK')
+                raise
+
+        if abandoned:
+            DownloadQueue.LOGGER.warning('Gave up on %d jobs whose leases kept expiring'
+                % abandoned)
+        reclaimed = sum(1 for row in rows if row[3] == 'leased')
+        if reclaimed:
+            DownloadQueue.LOGGER.info('Reclaimed %d jobs with expired leases' % reclaimed)
+        return [{'URL': url, 'File Name': file_name, 'Changed': bool(changed)}
+                for url, file_name, changed, state in rows]
+
+    @classmethod
+    def heartbeat(cls, owner):
+        # Extend every lease held by owner. Returns the number renewed.
+        now = time.time()
+        with cls._lock:
+            cursor = cls._connection().execute('''
+                UPDATE %s SET lease_expires = ?, heartbeat = ?
+                WHERE lease_owner = ? AND state = 'leased' ''' % cls.TABLE,
+                (now + cls.LEASE_SECONDS, now, owner))
+            return cursor.rowcount
+
+    @classmethod
+    def complete(cls, owner, url):
+        with cls._lock:
+            cls._connection().execute('''
+                UPDATE %s SET state = 'done', finished = ?, last_error = NULL
+                WHERE url = ? AND lease_owner = ? AND state = 'leased' ''' % cls.TABLE,
+                (time.time(), url, owner))
+
+    @classmethod
+    def fail(cls, owner, url, error):
+        # Retry later with exponential backoff, or give up after MAX_ATTEMPTS
+        now = time.time()
+        with cls._lock:
+            cls._connection().execute('''
+                UPDATE %s SET
+                state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END,
+                not_before = ? + ? * (1 << (attempts - 1)),
+                last_error = ?, finished = ?
+                WHERE url = ? AND lease_owner = ? AND state = 'leased' ''' % cls.TABLE,
+                (cls.MAX_ATTEMPTS, now, cls.RETRY_DELAY, error, now, url, owner))
+
+    @classmethod
+    def counts(cls):
+        # {state: jobs}, counting expired leases as pending
+        now = time.time()
+        with cls._lock:
+            rows = cls._connection().execute('''
+                SELECT CASE WHEN state = 'leased' AND lease_expires < ? THEN 'pending'
+                ELSE state END, COUNT(*) FROM %s GROUP BY 1''' % cls.TABLE, (now,))
+            return dict(rows.fetchall())
+
+    @classmethod
+    def next_due(cls):
+        # Seconds until the earliest job becomes claimable, or None when no
+        # job is pending or leased
+        now = time.time()
+        with cls._lock:
+            due = cls._connection().execute('''
+                SELECT MIN(CASE WHEN state = 'pending' THEN not_before ELSE lease_expires END)
+                FROM %s WHERE state IN ('pending', 'leased')''' % cls.TABLE).fetchone()[0]
+        if due is None:
+            return None
+        return max(0, due - now)
+
+
+class Worker(object):
+    """Claims download jobs in batches and downloads them, until the queue
+    is empty or, when following, until stopped.
+    """
+    LOGGER = logging.getLogger('root')
+
+    BATCH_SIZE = 20
+    IDLE_WAIT = 5
+
+    @classmethod
+    def set_batch_size(cls, size):
+        cls.BATCH_SIZE = max(1, int(size))
+
+    def __init__(self, fetch, follow=False):
+        # fetch(files) downloads a batch of file dicts and returns an error
+        # string or None for each
+        self.fetch = fetch
+        self.follow = follow
+        self.owner = DownloadQueue.make_owner()
+        self.stopped = threading.Event()
+        self.counts = {'succeeded': 0, 'failed': 0}
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        Worker.LOGGER.info('Worker %s started' % self.owner)
+        while not(self.stopped.is_set()):
+            files = DownloadQueue.claim(self.owner, Worker.BATCH_SIZE)
+            if files:
+                self._run_batch(files)
+                continue
+
+            wait = DownloadQueue.next_due()
+            if wait is None and not(self.follow):
+                break
+            # Jobs are waiting out a retry delay or another worker's lease
+            self.stopped.wait(min(wait if wait is not None else Worker.IDLE_WAIT,
+                                  Worker.IDLE_WAIT) or 1)
+
+        Worker.LOGGER.info('Worker %s finished: %d downloaded, %d failed'
+            % (self.owner, self.counts['succeeded'], self.counts['failed']))
+        return self.counts
+
+    def _run_batch(self, files):
+        done = threading.Event()
+        beat = threading.Thread(target=self._heartbeat, args=(done,))
+        beat.daemon = True
+        beat.start()
+        try:
+            errors = self.fetch(files)
+        finally:
+            done.set()
+            beat.join()
+
+        for f, error in zip(files, errors):
+            try:
+                if error:
+                    DownloadQueue.fail(self.owner, f['URL'], error)
+                else:
+                    DownloadQueue.complete(self.owner, f['URL'])
+            except sqlite3.Error as e:
+                # The job stays leased to us; once the lease runs out it is
+                # claimed again
+                Worker.LOGGER.warning('Could not update the job for %s: %s' % (f['URL'], e))
+            self.counts['failed' if error else 'succeeded'] += 1
+
+    def _heartbeat(self, done):
+        # Renew the batch's leases well before they run out
+        while not(done.wait(DownloadQueue.LEASE_SECONDS / 3.0)):
+            try:
+                DownloadQueue.heartbeat(self.owner)
+            except sqlite3.Error as e:
+                Worker.LOGGER.warning('Lease heartbeat failed: %s' % e)
@@ -0,0 +1,161 @@
+import logging
+import re
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from urlparse import urlparse
+from frblogger import replace_file
+
+
+class Metrics(object):
+    """Stage timings and event counters for one run.
+
+    Everything is labelled with a host name, so the listing requests, the
+    processing stages and the downloads of one bank land under the same
+    label. Stage times are cumulative: work done on several threads at once
+    adds up to more than the wall clock.
+    """
+    LOGGER = logging.getLogger('root')
+
+    STATSD = None  # (host, port)
+    STATSD_PREFIX = 'scrapefrb'
+    PROMETHEUS_FILE = None
+
+    _lock = threading.Lock()
+    _stages = {}
+    _counters = {}
+    _started = time.time()
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._stages = {}
+            cls._counters = {}
+            cls._started = time.time()
+
+    @classmethod
+    def set_statsd(cls, address):
+        host, _, port = address.rpartition(':')
+        cls.STATSD = (host or 'localhost', int(port))
+
+    @classmethod
+    def set_prometheus_file(cls, path):
+        cls.PROMETHEUS_FILE = path
+
+    @staticmethod
+    def label(url):
+        return urlparse(url).netloc.lower() or url
+
+    @classmethod
+    @contextmanager
+    def timer(cls, label, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            cls.add_time(label, stage, time.time() - start)
+
+    @classmethod
+    def add_time(cls, label, stage, seconds):
+        with cls._lock:
+            stages = cls._stages.setdefault(label, {})
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @classmethod
+    def incr(cls, label, name, count=1):
+        with cls._lock:
+            counters = cls._counters.setdefault(label, {})
+            counters[name] = counters.get(name, 0) + count
+
+    @classmethod
+    def counter(cls, label, name):
+        with cls._lock:
+            return cls._counters.get(label, {}).get(name, 0)
+
+    @classmethod
+    def total(cls, name):
+        # A counter summed over every bank
+        with cls._lock:
+            return sum(counters.get(name, 0) for counters in cls._counters.itervalues())
+
+    @classmethod
+    def report(cls):
+        with cls._lock:
+            labels = sorted(set(cls._stages) | set(cls._counters))
+            banks = {}
+            for label in labels:
+                banks[label] = {
+                    'stages': dict((k, round(v, 4)) for k, v in
+                                   cls._stages.get(label, {}).iteritems()),
+                    'counters': dict(cls._counters.get(label, {}))
+                }
+        finished = time.time()
+        return {
+            'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(cls._started)),
+            'finished': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(finished)),
+            'seconds': round(finished - cls._started, 4),
+            'banks': banks
+        }
+
+    @classmethod
+    def publish(cls, report=None):
+        # Push the report to StatsD and/or a Prometheus textfile, if configured
+        report = report or cls.report()
+        if cls.STATSD:
+            try:
+                cls._send_statsd(report)
+            except (socket.error, IOError) as e:
+                cls.LOGGER.warning('Could not send StatsD metrics: %s' % e)
+        if cls.PROMETHEUS_FILE:
+            try:
+                cls._write_prometheus(report)
+            except (IOError, OSError) as e:
+                cls.LOGGER.warning('Could not write %s: %s' % (cls.PROMETHEUS_FILE, e))
+
+    @classmethod
+    def _send_statsd(cls, report):
+        lines = ['%s.run.seconds:%d|ms' % (cls.STATSD_PREFIX, report['seconds'] * 1000)]
+        for label, values in report['banks'].iteritems():
+            prefix = '%s.%s' % (cls.STATSD_PREFIX, re.sub(r'[^\w-]', '_', label))
+            for stage, seconds in values['stages'].iteritems():
+                lines.append('%s.%s:%d|ms' % (prefix, stage, seconds * 1000))
+            for name, count in values['counters'].iteritems():
+                lines.append('%s.%s:%d|c' % (prefix, name, count))
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            # Stay well under a typical MTU per datagram
+            packet = []
+            for line in lines:
+                if packet and sum(len(l) + 1 for l in packet) + len(line) > 512:
+                    sock.sendto('\n'.join(packet), cls.STATSD)
+                    packet = []
+                packet.append(line)
+            if packet:
+                sock.sendto('\n'.join(packet), cls.STATSD)
+        finally:
+            sock.close()
+
+    @classmethod
+    def _write_prometheus(cls, report):
+        lines = [
+            '# TYPE scrapefrb_run_seconds gauge',
+            'scrapefrb_run_seconds %s' % report['seconds'],
+            '# TYPE scrapefrb_stage_seconds gauge',
+        ]
+        for label, values in sorted(report['banks'].iteritems()):
+            for stage, seconds in sorted(values['stages'].iteritems()):
+                lines.append('scrapefrb_stage_seconds{bank="%s",stage="%s"} %s'
+                    % (label, stage, seconds))
+        lines.append('# TYPE scrapefrb_events gauge')
+        for label, values in sorted(report['banks'].iteritems()):
+            for name, count in sorted(values['counters'].iteritems()):
+                lines.append('scrapefrb_events{bank="%s",event="%s"} %d'
+                    % (label, name, count))
+
+        # node_exporter may read the file at any time; replace it atomically
+        temp_name = cls.PROMETHEUS_FILE + '.tmp'
+        with open(temp_name, 'w') as outfile:
+            outfile.write('\n'.join(lines) + '\n')
+        replace_file(temp_name, cls.PROMETHEUS_FILE)
@@ -0,0 +1,101 @@
+import logging
+import re
+import threading
+from datetime import datetime
+from resultshandler import FRBDB
+
+# Separators sites put inside numbers, e.g. '1,234,567'
+NUMBER_NOISE = re.compile(r'[,\s]')
+
+
+def map_headers(headers):
+    # Return {generic column: index} for a list of site-specific headers.
+    # An exact (case-insensitive) match wins over a substring match, so
+    # 'NAME' is preferred to 'FILENAME'.
+    lowered = [h.lower() for h in headers]
+    fields = {}
+    for key in FRBDB.COLUMN_ORDER:
+        key_lower = key.lower()
+        if key_lower in lowered:
+            fields[key] = lowered.index(key_lower)
+            continue
+        for i, column in enumerate(lowered):
+            if key_lower in column:
+                fields[key] = i
+                break
+    return fields
+
+
+class Normalizer(object):
+    """Converts one bank's Documents into canonical form, a batch at a time:
+    ISO 'YYYY-MM-DD' posting dates and integer RSSD and year values.
+
+    There is one Normalizer per bank class, shared by every instance of that
+    bank. Posting dates repeat heavily, so parsed dates are memoized, up to
+    MEMO_SIZE distinct strings. Header maps are worked out once for each
+    distinct header list a site sends.
+    """
+    LOGGER = logging.getLogger('root')
+
+    MEMO_SIZE = 4096
+
+    _instances = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def for_bank(cls, bank_class):
+        with cls._lock:
+            normalizer = cls._instances.get(bank_class)
+            if normalizer is None:
+                normalizer = cls(bank_class.NAME, bank_class.DATE_FORMAT)
+                cls._instances[bank_class] = normalizer
+            return normalizer
+
+    def __init__(self, name, date_format):
+        self.name = name
+        self.date_format = date_format
+        self.header_maps = {}
+        self.dates = {}
+
+    def header_map(self, headers):
+        key = tuple(headers)
+        fields = self.header_maps.get(key)
+        if fields is None:
+            fields = map_headers(headers)
+            self.header_maps[key] = fields
+        return fields
+
+    def iso_date(self, text):
+        iso = self.dates.get(text)
+        if iso is None:
+            if len(self.dates) >= Normalizer.MEMO_SIZE:
+                # Stay bounded: start over rather than grow with the history
+                self.dates.clear()
+            iso = datetime.strptime(text.strip(), self.date_format).date().isoformat()
+            self.dates[text] = iso
+        return iso
+
+    def normalize(self, documents):
+        """Normalize a batch of Documents in place and return the ones that
+        could be converted. The rest are logged and left out.
+        """
+        iso_date = self.iso_date
+        kept = []
+        rejected = 0
+        for doc in documents:
+            try:
+                doc.date = iso_date(doc.date)
+                if not(isinstance(doc.rssd, (int, long))):
+                    doc.rssd = int(NUMBER_NOISE.sub('', doc.rssd))
+                if not(isinstance(doc.year, (int, long))):
+                    doc.year = int(NUMBER_NOISE.sub('', doc.year))
+            except (AttributeError, TypeError, ValueError) as e:
+                rejected += 1
+                Normalizer.LOGGER.debug('Skipping %r: %s' % (doc, e))
+            else:
+                kept.append(doc)
+
+        if rejected:
+            Normalizer.LOGGER.warning('%s: skipped %d of %d documents that could not be normalized'
+                % (self.name, rejected, len(documents)))
+        return kept
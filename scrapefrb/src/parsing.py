@@ -0,0 +1,26 @@
+import lxml.html
+from lxml import etree
+
+# Shared, precompiled XPath plans. Compiling once at import avoids
+# re-parsing the expression for every page and every row.
+HIDDEN_INPUTS = etree.XPath('//input[@type="hidden"][contains(@name, "__")]')
+ALL_TEXT = etree.XPath('.//text()')
+
+
+def html_tree(resp):
+    """Return the lxml tree for resp, parsing its body at most once."""
+    tree = getattr(resp, 'html_tree', None)
+    if tree is None:
+        tree = lxml.html.fromstring(resp.text)
+        resp.html_tree = tree
+    return tree
+
+
+def compact_text(element):
+    # All text below element, with every run of whitespace removed
+    return ''.join(''.join(ALL_TEXT(element)).split())
+
+
+def hidden_fields(tree):
+    # ASP.NET state (__VIEWSTATE, __EVENTVALIDATION, ...) keyed by input name
+    return dict((e.get('name'), e.get('value')) for e in HIDDEN_INPUTS(tree))
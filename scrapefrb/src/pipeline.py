@@ -0,0 +1,128 @@
+import logging
+import threading
+import traceback
+import Queue
+from bankhandler import FRB
+
+
+class Pipeline(object):
+    """Streams one bank's documents through three concurrent stages:
+
+        scrape -> normalize, diff and insert -> download
+
+    Each page or year of documents moves on as soon as it is parsed, so
+    downloads overlap the remaining listing requests. The bounded queues
+    between stages cap how many batches are held in memory at once.
+    """
+    LOGGER = logging.getLogger('root')
+
+    QUEUE_SIZE = 4
+
+    # Marks the end of a stage's output
+    _DONE = object()
+
+    @classmethod
+    def set_queue_size(cls, size):
+        cls.QUEUE_SIZE = max(1, int(size))
+
+    def __init__(self, bank_class):
+        self.bank = bank_class(run=False)
+        self.scraped = Queue.Queue(Pipeline.QUEUE_SIZE)
+        self.downloads = Queue.Queue(Pipeline.QUEUE_SIZE)
+        self.errors = []
+        self.counts = {'scraped': 0, 'new': 0, 'inserted': 0}
+        self.summary = {'succeeded': [], 'failed': [], 'skipped': [], 'queued': []}
+
+    def run(self):
+        """Run every stage to completion and return the download summary.
+        Re-raises the first error raised by any stage.
+        """
+        stages = [self._scrape, self._process, self._download]
+        threads = [threading.Thread(target=stage) for stage in stages]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+        if self.errors:
+            raise self.errors[0]
+
+        if not(self.counts['scraped']):
+            self.bank.logger.warning("No documents found at %s" % self.bank.URL)
+        self.bank.logger.info('Streamed %d documents, %d new, %d inserted'
+            % (self.counts['scraped'], self.counts['new'], self.counts['inserted']))
+        return self.summary
+
+    def _scrape(self):
+        try:
+            for docs in self.bank.iter_pages():
+                if self.errors:
+                    break
+                if docs:
+                    self.scraped.put(docs)
+        except Exception as e:
+            self._fail(e)
+        finally:
+            self.scraped.put(Pipeline._DONE)
+
+    def _process(self):
+        try:
+            handled = set()
+            for docs in self._drain(self.scraped):
+                self.counts['scraped'] += len(docs)
+                docs = self.bank.normalize_batch(docs)
+                new_docs = self.bank.find_new(docs)
+                self.counts['new'] += len(new_docs)
+                if new_docs:
+                    inserted, present = self.bank.insert(new_docs)
+                    self.counts['inserted'] += inserted
+
+                # The download manifest skips the files already downloaded.
+                # The whole batch goes along for the checks on known files.
+                urls = [doc.url for doc in docs]
+                handled.update(urls)
+                self.downloads.put((urls, docs))
+
+            if not(self.errors):
+                # Stored filings this crawl did not list again, whose files
+                # are still missing (failed or cut off in earlier runs)
+                backlog = [url for url in FRB.DB.undownloaded_urls(self.bank.BANK_CODE)
+                           if url not in handled]
+                if backlog:
+                    self.downloads.put((backlog, []))
+        except Exception as e:
+            self._fail(e)
+            self._discard(self.scraped)
+        finally:
+            self.downloads.put(Pipeline._DONE)
+
+    def _download(self):
+        try:
+            for urls, docs in self._drain(self.downloads):
+                summary = self.bank.download_urls(urls, known=docs)
+                for key in self.summary:
+                    self.summary[key] += summary[key]
+        except Exception as e:
+            self._fail(e)
+            self._discard(self.downloads)
+
+    def _fail(self, error):
+        Pipeline.LOGGER.error('%s pipeline stage failed:\n%s'
+            % (self.bank.NAME, traceback.format_exc()))
+        self.errors.append(error)
+
+    def _drain(self, queue):
+        # Yield batches until the upstream stage is done, skipping them once
+        # any stage has failed
+        while True:
+            docs = queue.get()
+            if docs is Pipeline._DONE:
+                return
+            if not(self.errors):
+                yield docs
+
+    def _discard(self, queue):
+        # Keep emptying a failed stage's input so upstream never blocks on put()
+        for docs in self._drain(queue):
+            pass
@@ -0,0 +1,161 @@
+import difflib
+import json
+import re
+import time
+from datetime import datetime, timedelta
+from resultshandler import FRBDB
+
+COLUMNS = ['doc_id', 'rssd_id', 'company', 'date', 'year', 'url', 'insert_date', 'frb_code']
+
+
+class DocumentQuery(object):
+    """Filters over the fry6 table: RSSD, company name, report year range,
+    bank code, posting date range, and for incremental reads the doc_id or
+    insert date to start after.
+
+    Name searches use the FTS5 index when the database has one, matching
+    each word of the name as a prefix. A fuzzy search widens that to names
+    sharing the first letters of any word, then keeps the close matches by
+    similarity.
+    """
+    FUZZY_PREFIX = 3
+    FUZZY_CUTOFF = 0.6
+
+    def __init__(self, rssd=None, name=None, years=None, bank=None,
+                 posted_since=None, posted_until=None, fuzzy=False, limit=None,
+                 after_id=None, inserted_since=None):
+        self.rssd = int(rssd) if rssd else None
+        self.name = name
+        self.years = parse_years(years) if years else None
+        self.bank = bank.upper() if bank else None
+        self.posted_since = parse_date(posted_since) if posted_since else None
+        self.posted_until = parse_date(posted_until) if posted_until else None
+        self.fuzzy = fuzzy
+        self.limit = int(limit) if limit else None
+        self.after_id = int(after_id) if after_id else None
+        self.inserted_since = parse_date(inserted_since) if inserted_since else None
+
+    @classmethod
+    def from_args(cls, args, limit=None):
+        # Raises ValueError for malformed option values
+        return cls(rssd=args['--rssd'], name=args['--name'], years=args['--year'],
+                   bank=args['--bank'], posted_since=args['--posted-since'],
+                   posted_until=args['--posted-until'], fuzzy=args['--fuzzy'],
+                   limit=limit, after_id=args['--after-id'],
+                   inserted_since=args['--inserted-since'])
+
+    def where(self, db):
+        """Return the WHERE clause (or '') and its parameters."""
+        clauses = []
+        params = []
+        if self.rssd is not None:
+            clauses.append('rssd_id = ?')
+            params.append(self.rssd)
+        if self.years:
+            clauses.append('year BETWEEN ? AND ?')
+            params += list(self.years)
+        if self.bank:
+            clauses.append('frb_code = ?')
+            params.append(self.bank)
+        # Dates compare as text: 'YYYY-MM-DD', or 'YYYY-MM-DD HH:MM:SS' in
+        # rows stored by older versions
+        if self.posted_since:
+            clauses.append('date >= ?')
+            params.append(self.posted_since.strftime('%Y-%m-%d'))
+        if self.posted_until:
+            # Through the end of that day
+            clauses.append('date < ?')
+            params.append((self.posted_until + timedelta(days=1)).strftime('%Y-%m-%d'))
+        if self.after_id is not None:
+            clauses.append('doc_id > ?')
+            params.append(self.after_id)
+        if self.inserted_since:
+            # insert_date holds the epoch seconds of the run that stored the row
+            clauses.append('CAST(insert_date AS REAL) >= ?')
+            params.append(time.mktime(self.inserted_since.timetuple()))
+
+        words = re.findall(r'\w+', self.name or '', re.UNICODE)
+        if words:
+            if db.has_fts:
+                clauses.append('doc_id IN (SELECT rowid FROM %s WHERE %s MATCH ?)'
+                    % (FRBDB.FTS_TABLE, FRBDB.FTS_TABLE))
+                params.append(self._match_expression(words))
+            else:
+                if self.fuzzy:
+                    words = [w[:DocumentQuery.FUZZY_PREFIX] for w in words]
+                joiner = ' OR ' if self.fuzzy else ' AND '
+                clauses.append('(%s)' % joiner.join(['company LIKE ?'] * len(words)))
+                params += ['%' + w + '%' for w in words]
+
+        if not(clauses):
+            return '', []
+        return 'WHERE ' + ' AND '.join(clauses), params
+
+    def _match_expression(self, words):
+        # Each word is a prefix; all must match, or any one when fuzzy
+        if self.fuzzy:
+            terms = ['"%s"*' % w[:DocumentQuery.FUZZY_PREFIX] for w in words]
+            return ' OR '.join(terms)
+        return ' '.join('"%s"*' % w for w in words)
+
+    def sql(self, db):
+        where, params = self.where(db)
+        statement = 'SELECT %s FROM %s %s ORDER BY doc_id' % (
+            ', '.join(COLUMNS), FRBDB.TABLE, where)
+        if self.limit and not(self.fuzzy):
+            statement += ' LIMIT %d' % self.limit
+        return statement, params
+
+    def rows(self, db):
+        """Return the matching rows as dicts, in doc_id order, or closest
+        first for a fuzzy name search.
+        """
+        statement, params = self.sql(db)
+        with db.lock:
+            rows = [dict(zip(COLUMNS, row)) for row in db.curs.execute(statement, params)]
+        if self.fuzzy and self.name:
+            rows = self._closest(rows)
+        return rows
+
+    def _closest(self, rows):
+        # Rank the widened candidates by name similarity
+        target = self.name.lower()
+        scored = []
+        for row in rows:
+            ratio = difflib.SequenceMatcher(None, target, (row['company'] or '').lower()).ratio()
+            if ratio >= DocumentQuery.FUZZY_CUTOFF:
+                scored.append((-ratio, row['doc_id'], row))
+        scored.sort()
+        rows = [row for ratio, doc_id, row in scored]
+        return rows[:self.limit] if self.limit else rows
+
+
+def parse_years(value):
+    # '2012' or '2010-2013' -> (first, last)
+    parts = str(value).split('-')
+    if len(parts) == 1:
+        return int(parts[0]), int(parts[0])
+    if len(parts) == 2:
+        first = int(parts[0]) if parts[0] else 0
+        last = int(parts[1]) if parts[1] else 9999
+        return first, last
+    raise ValueError('Invalid year range: %s' % value)
+
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def format_table(rows, columns=('rssd_id', 'company', 'year', 'date', 'frb_code', 'url')):
+    # A plain text table, with each column as wide as its widest value
+    cells = [[unicode(row[c]) if row[c] is not None else '' for c in columns] for row in rows]
+    widths = [max([len(c)] + [len(r[i]) for r in cells]) for i, c in enumerate(columns)]
+    lines = ['  '.join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines.append('  '.join('-' * w for w in widths))
+    for r in cells:
+        lines.append('  '.join(v.ljust(w) for v, w in zip(r, widths)))
+    return '\n'.join(lines)
+
+
+def format_json(rows):
+    return json.dumps(rows, indent=2, sort_keys=True)
@@ -0,0 +1,256 @@
+import logging
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse
+
+
+class HostLimiter(object):
+    """Token bucket for one host, refilled at a rate that adapts to how the
+    host responds.
+
+    Like TCP congestion control, the rate starts in slow start, growing by
+    one request/second per success, which roughly doubles it every second.
+    The first sign of trouble halves it and ends slow start. After that it
+    grows by 1/rate per success, about one request/second per second.
+    Trouble means any of:
+    - a 429 reply or a Retry-After header;
+    - more than ERROR_THRESHOLD of the last ERROR_WINDOW replies being
+      5xx or connection errors;
+    - latency well above the fastest this host has been.
+    """
+
+    def __init__(self, host, rate, ceiling=None):
+        self.host = host
+        self.rate = rate
+        self.ceiling = ceiling
+        self.tokens = 1.0
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.slow_start = True
+        self.last_decrease = 0
+        self.latency = None
+        self.baseline = None
+        self.outcomes = deque(maxlen=RateLimiter.ERROR_WINDOW)
+        self.lock = threading.Lock()
+        self.robots_lock = threading.Lock()
+        self.robots_checked = False
+
+    def set_crawl_delay(self, delay):
+        with self.lock:
+            ceiling = 1.0 / delay
+            self.ceiling = min(self.ceiling or ceiling, ceiling)
+            self.rate = min(self.rate, self.ceiling)
+
+    def acquire(self):
+        # Take a token, or reserve the next one. Returns the seconds waited.
+        with self.lock:
+            now = time.time()
+            capacity = max(1.0, self.rate * RateLimiter.BURST)
+            self.tokens = min(capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(0, -self.tokens / self.rate, self.blocked_until - now)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def feedback(self, latency=None, status=None, retry_after=None):
+        """Adjust the rate after a reply, or after a connection error when
+        status is None. Returns True when the rate was cut.
+        """
+        with self.lock:
+            now = time.time()
+            if retry_after:
+                self.blocked_until = max(self.blocked_until,
+                    now + min(retry_after, RateLimiter.RETRY_AFTER_MAX))
+
+            failed = status is None or status >= 500
+            self.outcomes.append(failed)
+            congested = status == 429 or bool(retry_after)
+            if failed:
+                # A stray error is not a sign of overload; a run of them is
+                congested = congested or (len(self.outcomes) == self.outcomes.maxlen and
+                    sum(self.outcomes) > RateLimiter.ERROR_THRESHOLD * len(self.outcomes))
+            elif latency is not None and not(congested):
+                if self.latency is None:
+                    self.latency = self.baseline = latency
+                else:
+                    self.latency += RateLimiter.LATENCY_WEIGHT * (latency - self.latency)
+                    # The baseline follows the fastest replies, and drifts up
+                    # slowly should the host get slower for good
+                    self.baseline = min(self.latency,
+                        self.baseline + 0.01 * (self.latency - self.baseline))
+                congested = (self.latency > self.baseline * RateLimiter.LATENCY_FACTOR
+                    and self.latency - self.baseline > RateLimiter.LATENCY_SLACK)
+
+            if congested:
+                # Cut at most once per round trip, so one burst of failures
+                # does not collapse the rate
+                if now - self.last_decrease < max(1.0, self.latency or 0):
+                    return False
+                self.rate = max(RateLimiter.MIN_RATE, self.rate * RateLimiter.DECREASE)
+                self.slow_start = False
+                self.last_decrease = now
+                self.outcomes.clear()
+                return True
+
+            if failed:
+                return False
+            if self.slow_start:
+                self.rate += 1.0
+            else:
+                self.rate += 1.0 / self.rate
+            if self.ceiling:
+                self.rate = min(self.rate, self.ceiling)
+            return False
+
+
+class RateLimiter(object):
+    """Per-host request pacing for every HTTP request HTTPClient sends.
+
+    Each host gets a HostLimiter, which adapts its rate to the replies.
+    Retry-After headers hold back every request to that host until the
+    given time. A Crawl-delay in the host's robots.txt caps its rate.
+    """
+    LOGGER = logging.getLogger('root')
+
+    ENABLED = True
+    ROBOTS = True
+    INITIAL_RATE = 10.0  # requests/second
+    MIN_RATE = 0.1
+    MAX_RATE = None  # no ceiling
+    BURST = 0.5  # seconds of requests that may go out back-to-back
+    DECREASE = 0.5
+    ERROR_WINDOW = 20
+    ERROR_THRESHOLD = 0.2
+    LATENCY_WEIGHT = 0.2
+    LATENCY_FACTOR = 3.0
+    LATENCY_SLACK = 0.5  # seconds
+    RETRY_AFTER_MAX = 600
+    ROBOTS_TIMEOUT = 10
+    # robots.txt groups that apply to us
+    AGENTS = ('*', 'scrapefrb')
+
+    _hosts = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def set_enabled(cls, enabled):
+        cls.ENABLED = enabled
+
+    @classmethod
+    def set_max_rate(cls, rate):
+        rate = float(rate)
+        cls.MAX_RATE = rate if rate > 0 else None
+        if cls.MAX_RATE:
+            cls.INITIAL_RATE = min(cls.INITIAL_RATE, cls.MAX_RATE)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls._hosts = {}
+
+    @classmethod
+    def host(cls, url):
+        netloc = urlparse(url).netloc.lower()
+        with cls._lock:
+            limiter = cls._hosts.get(netloc)
+            if limiter is None:
+                limiter = HostLimiter(netloc, cls.INITIAL_RATE, cls.MAX_RATE)
+                cls._hosts[netloc] = limiter
+            return limiter
+
+    @classmethod
+    def acquire(cls, url, session):
+        """Wait for this host's next request slot. session fetches the
+        host's robots.txt the first time. Returns the seconds waited.
+        """
+        if not(cls.ENABLED):
+            return 0
+        limiter = cls.host(url)
+        if cls.ROBOTS and not(limiter.robots_checked):
+            with limiter.robots_lock:
+                if not(limiter.robots_checked):
+                    cls._read_robots(url, limiter, session)
+                    limiter.robots_checked = True
+        return limiter.acquire()
+
+    @classmethod
+    def feedback(cls, url, latency=None, status=None, retry_after=None):
+        if not(cls.ENABLED):
+            return False
+        limiter = cls.host(url)
+        cut = limiter.feedback(latency, status, parse_retry_after(retry_after))
+        if cut:
+            cls.LOGGER.debug('Slowing %s to %0.2f requests/second (%s)'
+                % (limiter.host, limiter.rate, status or 'connection error'))
+        return cut
+
+    @classmethod
+    def rates(cls):
+        with cls._lock:
+            return dict((host, round(limiter.rate, 2)) for host, limiter in cls._hosts.iteritems())
+
+    @classmethod
+    def _read_robots(cls, url, limiter, session):
+        parts = urlparse(url)
+        robots_url = '%s://%s/robots.txt' % (parts.scheme, parts.netloc)
+        try:
+            r = session.get(robots_url, timeout=cls.ROBOTS_TIMEOUT)
+            text = r.text if r.status_code == 200 else ''
+            r.close()
+        except Exception as e:
+            cls.LOGGER.debug('Could not read %s: %s' % (robots_url, e))
+            return
+        delay = crawl_delay(text, cls.AGENTS)
+        if delay:
+            cls.LOGGER.info('%s asks for a crawl delay of %s seconds' % (limiter.host, delay))
+            limiter.set_crawl_delay(delay)
+
+
+def crawl_delay(robots_text, agents):
+    # The Crawl-delay of the first group naming one of agents, preferring a
+    # group that names us over the '*' group
+    delays = {}
+    group = []
+    in_rules = False
+    for line in robots_text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if ':' not in line:
+            continue
+        field, value = [part.strip() for part in line.split(':', 1)]
+        field = field.lower()
+        if field == 'user-agent':
+            if in_rules:
+                group = []
+                in_rules = False
+            group.append(value.lower())
+        else:
+            in_rules = True
+            if field == 'crawl-delay':
+                try:
+                    delay = float(value)
+                except ValueError:
+                    continue
+                for agent in group:
+                    delays.setdefault(agent, delay)
+    for agent in reversed(agents):
+        if delays.get(agent, 0) > 0:
+            return delays[agent]
+    return None
+
+
+def parse_retry_after(value):
+    # Retry-After is either seconds or an HTTP date
+    if not(value):
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0, mktime_tz(parsed) - time.time())
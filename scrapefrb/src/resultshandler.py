@@ -1,9 +1,18 @@
 import sqlite3
+import hashlib
+import shutil
 import time
+from datetime import datetime
 import os
-import sys
 import logging
+import threading
 import requests
+from fetchpool import FetchPool
+from httpclient import HTTPClient
+from metrics import Metrics
+from archive import ResponseArchive
+from frblogger import replace_file
+from jobqueue import DownloadQueue
 from urllib import quote
 from urlparse import urlparse
 
@@ -44,145 +53,701 @@ class FRBDB(object):
         ''' % (TABLE)
     )
 
+    # Secondary indexes for the query and export filters
+    INDEX_STATEMENTS = [
+        'CREATE INDEX IF NOT EXISTS %s_rssd ON %s (rssd_id)' % (TABLE, TABLE),
+        'CREATE INDEX IF NOT EXISTS %s_year ON %s (year, frb_code)' % (TABLE, TABLE),
+        'CREATE INDEX IF NOT EXISTS %s_bank ON %s (frb_code, year)' % (TABLE, TABLE),
+        'CREATE INDEX IF NOT EXISTS %s_date ON %s (date)' % (TABLE, TABLE),
+    ]
+
+    # Full-text index over company names, kept in step with TABLE by triggers
+    FTS_TABLE = 'fry6_fts'
+
+    CREATE_FTS_STATEMENT = ('''
+        CREATE VIRTUAL TABLE %s USING fts5
+        (company, content='%s', content_rowid='doc_id', prefix='2 3')
+        ''' % (FTS_TABLE, TABLE)
+    )
+
+    FTS_TRIGGER_STATEMENTS = [
+        '''CREATE TRIGGER IF NOT EXISTS %(t)s_ai AFTER INSERT ON %(t)s BEGIN
+            INSERT INTO %(f)s (rowid, company) VALUES (new.doc_id, new.company);
+        END''' % {'t': TABLE, 'f': FTS_TABLE},
+        '''CREATE TRIGGER IF NOT EXISTS %(t)s_ad AFTER DELETE ON %(t)s BEGIN
+            INSERT INTO %(f)s (%(f)s, rowid, company) VALUES ('delete', old.doc_id, old.company);
+        END''' % {'t': TABLE, 'f': FTS_TABLE},
+        '''CREATE TRIGGER IF NOT EXISTS %(t)s_au AFTER UPDATE OF company ON %(t)s BEGIN
+            INSERT INTO %(f)s (%(f)s, rowid, company) VALUES ('delete', old.doc_id, old.company);
+            INSERT INTO %(f)s (rowid, company) VALUES (new.doc_id, new.company);
+        END''' % {'t': TABLE, 'f': FTS_TABLE},
+    ]
+
+    # Rows already present under (rssd_id, year, company) are left untouched
     INSERT_STATEMENT = ('''
-        INSERT INTO %s 
+        INSERT OR IGNORE INTO %s 
         (doc_id, rssd_id, company, date, year, url, insert_date, frb_code)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''' % (TABLE)
     )
 
-    SELECT_STATEMENT = ('''
-        SELECT doc_id, rssd_id, company, date, year, url, insert_date, frb_code FROM %s
+    KEY_STATEMENT = ('''
+        SELECT rssd_id, company, year FROM %s
         ''' % (TABLE)
     )
 
+    MANIFEST_TABLE = 'downloads'
+
+    # One row per downloaded URL. path is relative to FRBDownload.PATH_NAME.
+    CREATE_MANIFEST_STATEMENT = ('''
+        CREATE TABLE IF NOT EXISTS %s
+        (url text PRIMARY KEY,
+        path text,
+        size integer,
+        etag text,
+        last_modified text,
+        content_length integer,
+        sha256 text,
+        download_date text)
+        ''' % (MANIFEST_TABLE)
+    )
+
+    RECORD_MANIFEST_STATEMENT = ('''
+        INSERT OR REPLACE INTO %s
+        (url, path, size, etag, last_modified, content_length, sha256, download_date)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''' % (MANIFEST_TABLE)
+    )
+
+    AUDIT_TABLE = 'audits'
+
+    # The result of the last `scrapefrb verify` check of each file in
+    # FRBDownload.PATH_NAME. error is NULL for a file that passed.
+    CREATE_AUDIT_STATEMENT = ('''
+        CREATE TABLE IF NOT EXISTS %s
+        (path text PRIMARY KEY,
+        size integer,
+        mtime real,
+        sha256 text,
+        error text,
+        audit_date text)
+        ''' % (AUDIT_TABLE)
+    )
+
+    RECORD_AUDIT_STATEMENT = ('''
+        INSERT OR REPLACE INTO %s (path, size, mtime, sha256, error, audit_date)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ''' % (AUDIT_TABLE)
+    )
+
+    # Keep IN (...) lists below SQLite's bound parameter limit
+    LOOKUP_BATCH = 500
+    # Seconds to wait on a lock held by a worker or another scrapefrb run
+    BUSY_TIMEOUT = 60
+    # PRAGMA user_version once the one-time data migrations have run
+    SCHEMA_VERSION = 1
+
     @classmethod
     def set_working_path(cls, path):
         cls.FILE_NAME = os.path.join(path, cls.FILE_NAME)
         #print cls.FILE_NAME
 
     def __init__(self):
-        self.conn = sqlite3.connect(FRBDB.FILE_NAME)
+        # Banks may run on separate worker threads. The connection is shared,
+        # so every statement goes through self.lock.
+        self.conn = sqlite3.connect(FRBDB.FILE_NAME, timeout=FRBDB.BUSY_TIMEOUT,
+                                    check_same_thread=False)
         self.curs = self.conn.cursor()
+        self.lock = threading.RLock()
 
         self.timestamp = time.time()
-        self._old_documents = None
+        self._old_keys = None
+        self.has_fts = False
         self.create()
-        self._fetch_old_documents()
 
     @property
-    def old_documents(self):
-        return self._old_documents
-
-    @property
-    def old_id_pairs(self):
-        if self._old_documents:
-            return [(row[1], row[2], row[4]) for row in self._old_documents]
+    def old_keys(self):
+        # Loaded once per run and shared by every bank. insert_data keeps it
+        # current as new rows are written.
+        with self.lock:
+            if self._old_keys is None:
+                self._old_keys = set(FRBDB.make_key(*row) for row in
+                    self.curs.execute(FRBDB.KEY_STATEMENT))
+            return self._old_keys
+
+    def newest_year(self, bank_code):
+        with self.lock:
+            return self.curs.execute('SELECT MAX(year) FROM %s WHERE frb_code = ?'
+                % FRBDB.TABLE, (bank_code,)).fetchone()[0]
+
+    @staticmethod
+    def make_key(rssd_id, company, year):
+        # SQLite hands back integers for rssd_id and year; the scrapers
+        # produce strings. Normalize both sides to the database types.
+        try:
+            rssd_id = int(rssd_id)
+        except (TypeError, ValueError):
+            pass
+        try:
+            year = int(year)
+        except (TypeError, ValueError):
+            pass
+        return (rssd_id, company, year)
 
     def create(self):
-        self.curs.execute(FRBDB.CREATE_STATEMENT)
+        with self.lock:
+            self.curs.execute(FRBDB.CREATE_STATEMENT)
+            self.curs.execute(FRBDB.CREATE_MANIFEST_STATEMENT)
+            self.curs.execute(FRBDB.CREATE_AUDIT_STATEMENT)
+            # Manifests created before content hashing lack the sha256 column
+            columns = [row[1] for row in self.curs.execute(
+                'PRAGMA table_info(%s)' % FRBDB.MANIFEST_TABLE)]
+            if 'sha256' not in columns:
+                self.curs.execute('ALTER TABLE %s ADD COLUMN sha256 text'
+                    % FRBDB.MANIFEST_TABLE)
+            version = self.curs.execute('PRAGMA user_version').fetchone()[0]
+            if version < 1:
+                # Rows stored before normalization have 'YYYY-MM-DD HH:MM:SS' dates
+                self.curs.execute('UPDATE %s SET date = substr(date, 1, 10) WHERE length(date) > 10'
+                    % FRBDB.TABLE)
+            if version < FRBDB.SCHEMA_VERSION:
+                self.conn.commit()
+                self.curs.execute('PRAGMA user_version = %d' % FRBDB.SCHEMA_VERSION)
+            for statement in FRBDB.INDEX_STATEMENTS:
+                self.curs.execute(statement)
+            self.conn.commit()
+            self._create_fts()
+
+    def _create_fts(self):
+        # FTS5 is optional in SQLite builds; without it name searches fall
+        # back to LIKE
+        exists = self.curs.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (FRBDB.FTS_TABLE,)).fetchone()
+        try:
+            with self.conn:
+                if not(exists):
+                    self.curs.execute(FRBDB.CREATE_FTS_STATEMENT)
+                    # Index the rows stored before the FTS table existed
+                    self.curs.execute("INSERT INTO %s (%s) VALUES ('rebuild')"
+                        % (FRBDB.FTS_TABLE, FRBDB.FTS_TABLE))
+                for statement in FRBDB.FTS_TRIGGER_STATEMENTS:
+                    self.curs.execute(statement)
+        except sqlite3.OperationalError as e:
+            FRBDB.LOGGER.debug('No full-text index (%s)' % e)
+            return
+        self.has_fts = True
+
+    def manifest_entries(self, urls):
+        """Return {url: (path, size, etag, last_modified, content_length,
+        sha256)} for every URL in urls that has been downloaded before.
+        """
+        urls = list(urls)
+        entries = {}
+        with self.lock:
+            for i in xrange(0, len(urls), FRBDB.LOOKUP_BATCH):
+                batch = urls[i:i + FRBDB.LOOKUP_BATCH]
+                rows = self.curs.execute('''
+                    SELECT url, path, size, etag, last_modified, content_length, sha256
+                    FROM %s WHERE url IN (%s)''' % (FRBDB.MANIFEST_TABLE,
+                    ', '.join('?' * len(batch))), batch)
+                for row in rows:
+                    entries[row[0]] = row[1:]
+        return entries
+
+    def undownloaded_urls(self, bank_code):
+        # The URLs of a bank's stored filings with no download manifest
+        # entry: files never fetched, or whose download failed
+        with self.lock:
+            rows = self.curs.execute('''
+                SELECT f.url FROM %s f LEFT JOIN %s d ON d.url = f.url
+                WHERE f.frb_code = ? AND d.url IS NULL ORDER BY f.doc_id'''
+                % (FRBDB.TABLE, FRBDB.MANIFEST_TABLE), (bank_code,)).fetchall()
+        return [row[0] for row in rows]
+
+    def record_downloads(self, records):
+        # records are (url, path, size, etag, last_modified, content_length,
+        # sha256)
+        download_date = datetime.now()
+        with self.lock:
+            with self.conn:
+                self.curs.executemany(FRBDB.RECORD_MANIFEST_STATEMENT,
+                    [tuple(r) + (download_date,) for r in records])
+
+    def manifest_by_path(self):
+        # {path: (url, size, content_length, sha256)} for every download
+        with self.lock:
+            rows = self.curs.execute('SELECT path, url, size, content_length, sha256 FROM %s'
+                % FRBDB.MANIFEST_TABLE).fetchall()
+        return dict((row[0], row[1:]) for row in rows)
+
+    def audit_entries(self):
+        # {path: (size, mtime, sha256, error)} from the last audit
+        with self.lock:
+            rows = self.curs.execute('SELECT path, size, mtime, sha256, error FROM %s'
+                % FRBDB.AUDIT_TABLE).fetchall()
+        return dict((row[0], row[1:]) for row in rows)
+
+    def record_audits(self, records):
+        # records are (path, size, mtime, sha256, error)
+        audit_date = datetime.now()
+        with self.lock:
+            with self.conn:
+                self.curs.executemany(FRBDB.RECORD_AUDIT_STATEMENT,
+                    [tuple(r) + (audit_date,) for r in records])
+
+    def enable_wal(self):
+        # Write-ahead logging lets readers continue during a batch insert
+        with self.lock:
+            mode = self.curs.execute('PRAGMA journal_mode=WAL').fetchone()[0]
+            self.curs.execute('PRAGMA synchronous=NORMAL')
+        FRBDB.LOGGER.info('SQLite journal mode: %s' % mode)
+
+    def insert_documents(self, documents):
+        return self.insert_data(self.prepare_documents(documents))
+
+    def insert_data(self, data):
+        """Insert all rows in a single transaction.
+
+        Returns (inserted, present), where present counts the rows skipped
+        because they were already stored.
+        """
+        with self.lock:
+            with self.conn:
+                self.curs.executemany(FRBDB.INSERT_STATEMENT, data)
+            # rowcount leaves out the full-text index rows written by triggers
+            inserted = max(0, self.curs.rowcount)
+
+            if self._old_keys is not None:
+                self._old_keys.update(FRBDB.make_key(datum[1], datum[2], datum[4])
+                    for datum in data)
+
+        return inserted, len(data) - inserted
+
+    def prepare_documents(self, documents):
+        # One insert record per Document, with a doc_id place holder
+        timestamp = self.timestamp
+        return [(None, doc.rssd, doc.name, doc.date, doc.year, doc.url, timestamp,
+                 doc.bank_code) for doc in documents]
 
-    def insert_data(self, data, key_map=None, bank_code=''):
-        if key_map:
-            data = self.prepare_keyed_data(data, key_map, bank_code)
+class FRBDownload(object):
+    LOGGER = logging.getLogger('root')
 
-        for datum in data:
-            try:
-                self.curs.execute(FRBDB.INSERT_STATEMENT, datum)
-            except sqlite3.IntegrityError:
-                raise sqlite3.IntegrityError(datum)
-            self.conn.commit()
+    PATH_NAME = 'downloads'
+    BLOB_PATH = 'blobs'
+    CHUNK_SIZE = 8192 # 8KB
+    TRANSFERS = 8
+    PART_SUFFIX = '.part'
+    # Holds the ETag or Last-Modified of the version a .part file belongs to
+    VALIDATOR_SUFFIX = '.part.validator'
+    DB = None
+    REFETCH_CHANGED = False
+    # Store each unique file once under BLOB_PATH, named by its SHA-256,
+    # and link the names in PATH_NAME to it
+    DEDUPE = False
+    # Hand new files to `scrapefrb worker` through DownloadQueue instead of
+    # downloading them here
+    QUEUE = False
 
-    def prepare_keyed_data(self, data, key_map, code):
-        temp = []
+    @classmethod
+    def set_database(cls, db):
+        cls.DB = db
 
-        # Arrange the data columns the database column order
-        mapped_columns = [key_map[col] for col in FRBDB.COLUMN_ORDER]
+    @classmethod
+    def set_refetch_changed(cls):
+        cls.REFETCH_CHANGED = True
 
-        for datum in data:
-            # build each insert record
-            this_record = [None] # doc_id place holder
-            this_record += [datum[column] for column in mapped_columns] # ordered columns
-            this_record.append(self.timestamp)
-            this_record.append(code)
-            temp.append(tuple(this_record)) # convert to tuple
-        return temp
+    @classmethod
+    def set_dedupe(cls):
+        cls.DEDUPE = True
 
-    def _fetch_old_documents(self):
-        self._old_documents = self.curs.execute(FRBDB.SELECT_STATEMENT).fetchall()
+    @classmethod
+    def set_queue(cls):
+        cls.QUEUE = True
 
-class FRBDownload(object):
-    LOGGER = logging.getLogger('root')
+    @classmethod
+    def set_transfers(cls, transfers):
+        cls.TRANSFERS = max(1, int(transfers))
 
-    PATH_NAME = 'downloads'
-    CHUNK_SIZE = 8192 # 8KB
+    @classmethod
+    def checks_known(cls):
+        # True when files already in the manifest need checking as well
+        return cls.REFETCH_CHANGED or cls.DEDUPE
 
     @classmethod
-    def download(cls, urls):
-        s = requests.Session()
+    def download(cls, urls, known_urls=None):
+        """Download every URL not already present locally. The manifest
+        entries of known_urls are checked too, see compare_local.
+
+        Up to TRANSFERS files are in flight at once, still subject to the
+        FetchPool per-host limit. A failed file is recorded and the rest of
+        the batch carries on. Returns a summary dict of 'succeeded',
+        'failed' (file name, error), 'skipped' and, with QUEUE, 'queued'
+        file names.
+        """
+        if ResponseArchive.REPLAY:
+            # Replays never reach the network. The files keep no manifest
+            # entry, so the next live run downloads them.
+            FRBDownload.LOGGER.info('Replay mode: leaving %d downloads for the next live run'
+                % len(urls))
+            return {'succeeded': [], 'failed': [], 'queued': [], 'skipped': []}
+
+        new_files = FRBDownload.compare_local(urls, known_urls)
+        new_urls = set(doc['URL'] for doc in new_files)
+        summary = {
+            'succeeded': [],
+            'failed': [],
+            'queued': [],
+            'skipped': [FRBDownload.make_local_name(url) for url in urls
+                        if url not in new_urls]
+        }
+        for url in urls:
+            if url not in new_urls:
+                Metrics.incr(Metrics.label(url), 'files_skipped')
+
+        if FRBDownload.QUEUE:
+            if new_files:
+                DownloadQueue.enqueue(new_files)
+            summary['queued'] = [doc['File Name'] for doc in new_files]
+            for doc in new_files:
+                Metrics.incr(Metrics.label(doc['URL']), 'files_queued')
+            FRBDownload.LOGGER.info('Queued %d files for download workers (%d already present)'
+                % (len(new_files), len(summary['skipped'])))
+            return summary
 
-        new_files = FRBDownload.compare_local(urls)
         total_files = len(new_files)
+        FRBDownload.LOGGER.info('Downloading %d files (%d already present)'
+            % (total_files, len(summary['skipped'])))
 
-        for i, doc in enumerate(new_files):
-            url = doc.get('URL')
-            file_name = doc.get('File Name')
+        results = FRBDownload.fetch_files(new_files)
 
-            req = requests.Request('GET', url)
-            prepped = req.prepare()
-            r = s.send(prepped, stream=True)
-            if not(r.ok):
-                FRBDownload.LOGGER.warning('ERROR (%s) retreiving %s' 
-                    % (r.status_code, r.url))
-                return
+        for doc, error in zip(new_files, results):
+            if error:
+                summary['failed'].append((doc['File Name'], error))
+            else:
+                summary['succeeded'].append(doc['File Name'])
 
-            file_name_abs = os.path.join(FRBDownload.PATH_NAME, file_name)
+        FRBDownload.LOGGER.info('Downloads finished: %d succeeded, %d failed, %d skipped'
+            % (len(summary['succeeded']), len(summary['failed']), len(summary['skipped'])))
+        for file_name, error in summary['failed']:
+            FRBDownload.LOGGER.warning('Failed to download %s: %s' % (file_name, error))
+        return summary
 
+    @classmethod
+    def fetch_files(cls, files):
+        # Download file dicts from compare_local, TRANSFERS at a time.
+        # Returns None or an error string for each, in order.
+        results = FetchPool.map(FRBDownload._fetch, files, lambda doc: doc['URL'],
+                                workers=FRBDownload.TRANSFERS)
+        for doc, error in zip(files, results):
+            if error:
+                Metrics.incr(Metrics.label(doc['URL']), 'files_failed')
+            else:
+                Metrics.incr(Metrics.label(doc['URL']), 'files_downloaded')
+        return results
+
+    @classmethod
+    def _fetch(cls, doc):
+        # Download one file. Returns None on success, or an error string.
+        # Bytes land in a .part file first, which is resumed with a Range
+        # request on the next attempt and only renamed into place once its
+        # size matches the server's content-length. The resume is
+        # conditional on If-Range, so a file that changed on the server in
+        # the meantime is sent whole instead of spliced onto old bytes.
+        url = doc.get('URL')
+        file_name = doc.get('File Name')
+        file_name_abs = os.path.join(FRBDownload.PATH_NAME, file_name)
+        part_name_abs = file_name_abs + FRBDownload.PART_SUFFIX
+        validator_name_abs = file_name_abs + FRBDownload.VALIDATOR_SUFFIX
+
+        if doc.get('Changed') and os.path.exists(part_name_abs):
+            # A partial copy of the old version must not be resumed
+            os.remove(part_name_abs)
+
+        try:
+            offset = os.path.getsize(part_name_abs)
+        except OSError:
+            offset = 0
+
+        validator = FRBDownload._read_validator(validator_name_abs) if offset else None
+        if offset and not(validator):
+            # Without a validator there is no telling which version the
+            # partial bytes came from
+            offset = 0
+
+        # The content hash is computed as the bytes arrive
+        digest = hashlib.sha256()
+
+        # Compressed transfers would not match content-length or Range offsets
+        headers = {'Accept-Encoding': 'identity'}
+        if offset:
+            headers['Range'] = 'bytes=%d-' % offset
+            headers['If-Range'] = validator
+
+        try:
+            r = HTTPClient.get(url, headers=headers, stream=True)
             try:
-                remote_size = int(r.headers['content-length'])
-            except ValueError:
-                remote_size = -1
-
-            # Download the file
-            with open(file_name_abs, 'wb') as outfile:
-                local_size = 0
-                for chunk in r.iter_content(chunk_size=FRBDownload.CHUNK_SIZE):
-                    local_size += len(chunk)
-                    sys.stdout.write('\rDownloading file #%d/%d. Completed: %d%%' % 
-                        (i + 1, total_files, 100.0 * local_size / remote_size))
-                    sys.stdout.flush()
-                    outfile.write(chunk)
-                sys.stdout.write('\n')
+                if r.status_code == 416 and offset:
+                    # The .part file is already complete (or bogus); start over
+                    r.close()
+                    os.remove(part_name_abs)
+                    offset = 0
+                    del headers['Range']
+                    del headers['If-Range']
+                    r = HTTPClient.get(url, headers=headers, stream=True)
+
+                if not(r.ok):
+                    return 'HTTP %s' % r.status_code
+
+                if r.status_code == 206:
+                    mode = 'ab'
+                    remote_size = FRBDownload._range_total(r, offset)
+                    FRBDownload._hash_file(part_name_abs, digest)
+                else:
+                    # A full reply: the file changed since the partial copy
+                    # (If-Range), or the server ignores Range. Start over.
+                    mode = 'wb'
+                    offset = 0
+                    try:
+                        remote_size = int(r.headers.get('content-length'))
+                    except (TypeError, ValueError):
+                        remote_size = -1
+
+                validators = (r.headers.get('etag'), r.headers.get('last-modified'))
+                if mode == 'wb':
+                    FRBDownload._write_validator(validator_name_abs, *validators)
+
+                with open(part_name_abs, mode) as outfile:
+                    for chunk in r.iter_content(chunk_size=FRBDownload.CHUNK_SIZE):
+                        outfile.write(chunk)
+                        digest.update(chunk)
+            finally:
+                r.close()
+
+            local_size = os.path.getsize(part_name_abs)
+            Metrics.incr(Metrics.label(url), 'download_bytes', local_size - offset)
+            if remote_size >= 0 and local_size != remote_size:
+                return 'Incomplete transfer (%d of %d bytes, kept for resume)' % (
+                    local_size, remote_size)
+
+            sha256 = digest.hexdigest()
+            if FRBDownload.DEDUPE:
+                if FRBDownload._store_blob(part_name_abs, file_name_abs, sha256):
+                    Metrics.incr(Metrics.label(url), 'dedupe_hits')
+            else:
+                replace_file(part_name_abs, file_name_abs)
+            if os.path.exists(validator_name_abs):
+                os.remove(validator_name_abs)
+
+            FRBDownload.DB.record_downloads([(url, file_name, local_size) + validators +
+                (remote_size if remote_size >= 0 else None, sha256)])
+        except (requests.RequestException, IOError, OSError, sqlite3.Error) as e:
+            return str(e)
+
+        if offset:
+            FRBDownload.LOGGER.info('Finished Downloading %s (%d, resumed at %d)'
+                % (file_name, local_size, offset))
+        else:
             FRBDownload.LOGGER.info('Finished Downloading %s (%d)'
-                % (file_name, remote_size))
+                % (file_name, local_size))
+
+    @classmethod
+    def _read_validator(cls, validator_name_abs):
+        try:
+            with open(validator_name_abs) as infile:
+                return infile.read().strip() or None
+        except IOError:
+            return None
 
     @classmethod
-    def compare_local(cls, urls):
-        FRBDownload.LOGGER.info("Comparing remote URLs to local files in %s" % 
-            FRBDownload.PATH_NAME)
+    def _write_validator(cls, validator_name_abs, etag, last_modified):
+        # If-Range needs a strong ETag; otherwise fall back to Last-Modified
+        if etag and not(etag.startswith('W/')):
+            validator = etag
+        else:
+            validator = last_modified
+        if validator:
+            with open(validator_name_abs, 'w') as outfile:
+                outfile.write(validator)
+        elif os.path.exists(validator_name_abs):
+            os.remove(validator_name_abs)
 
-        existing_files = os.listdir(FRBDownload.PATH_NAME)
+    @classmethod
+    def blob_name(cls, sha256):
+        # Sharded two levels deep, so no directory holds too many blobs
+        return os.path.join(cls.BLOB_PATH, sha256[:2], sha256[2:4], sha256 + '.pdf')
+
+    @classmethod
+    def _store_blob(cls, part_name_abs, file_name_abs, sha256):
+        # Move a finished .part file into the blob store and link its name
+        # to it. Returns True when an identical blob was already stored.
+        blob = FRBDownload.blob_name(sha256)
+        duplicate = os.path.exists(blob)
+        if duplicate:
+            os.remove(part_name_abs)
+        else:
+            try:
+                os.makedirs(os.path.dirname(blob))
+            except OSError:
+                if not(os.path.isdir(os.path.dirname(blob))):
+                    raise
+            try:
+                os.rename(part_name_abs, blob)
+            except OSError:
+                # Another transfer stored the same content first
+                if not(os.path.exists(blob)):
+                    raise
+                os.remove(part_name_abs)
+        FRBDownload._link(blob, file_name_abs)
+        return duplicate
+
+    @classmethod
+    def _link(cls, blob, file_name_abs):
+        # Hardlink the readable name to the blob, or symlink it where
+        # hardlinks are not possible, or as a last resort copy it
+        if os.path.lexists(file_name_abs):
+            os.remove(file_name_abs)
+        try:
+            os.link(blob, file_name_abs)
+            return
+        except (AttributeError, OSError):
+            pass
+        try:
+            os.symlink(os.path.abspath(blob), file_name_abs)
+        except (AttributeError, OSError):
+            shutil.copyfile(blob, file_name_abs)
+
+    @classmethod
+    def _hash_file(cls, file_name_abs, digest):
+        # Feed the bytes already on disk into digest
+        with open(file_name_abs, 'rb') as infile:
+            for chunk in iter(lambda: infile.read(FRBDownload.CHUNK_SIZE * 8), ''):
+                digest.update(chunk)
+
+    @classmethod
+    def _range_total(cls, resp, offset):
+        # Content-Range: bytes 1000-1999/2000
+        content_range = resp.headers.get('content-range', '')
+        try:
+            return int(content_range.rsplit('/', 1)[1])
+        except (IndexError, ValueError):
+            pass
+        try:
+            return offset + int(resp.headers.get('content-length'))
+        except (TypeError, ValueError):
+            return -1
+
+    @classmethod
+    def compare_local(cls, urls, known_urls=None):
+        """Return the files among urls that need downloading.
+
+        URLs are looked up in the download manifest. The manifest entries
+        of urls and known_urls are then checked: with DEDUPE, missing links
+        to stored blobs are restored; with REFETCH_CHANGED, files whose
+        remote validators differ from the recorded ones are returned as
+        well.
+        """
+        FRBDownload.LOGGER.info("Comparing remote URLs to the download manifest")
+
+        entries = FRBDownload.DB.manifest_entries(urls)
         files = []
 
-        for url in urls:
-            one_file = {}
-            one_file['URL'] = url
-            file_name = url.split('/')[-1]
-            if 'aspx' in file_name.lower():
-                url_query = urlparse(url)[4] # query component
-                file_name = url_query.split('=')[1] # just the query value
-                file_name += '_stlfrb.pdf'
-            one_file['File Name'] = file_name
-            files.append(one_file)
+        unknown = [url for url in urls if url not in entries]
+        if unknown:
+            # Files downloaded before the manifest existed are adopted by name
+            existing_files = set(os.listdir(FRBDownload.PATH_NAME))
+            adopted = []
+            for url in unknown:
+                file_name = FRBDownload.make_local_name(url)
+                if file_name in existing_files:
+                    size = os.path.getsize(os.path.join(FRBDownload.PATH_NAME, file_name))
+                    adopted.append((url, file_name, size, None, None, None, None))
+                else:
+                    files.append({'URL': url, 'File Name': file_name})
+            if adopted:
+                FRBDownload.LOGGER.info('Added %d existing files to the download manifest'
+                    % len(adopted))
+                FRBDownload.DB.record_downloads(adopted)
+
+        if known_urls:
+            entries = FRBDownload.DB.manifest_entries(set(urls) | set(known_urls))
+
+        if entries and FRBDownload.DEDUPE:
+            FRBDownload._restore_links(entries)
+
+        if entries and FRBDownload.REFETCH_CHANGED:
+            files += FRBDownload._changed_files(entries)
+
+        return files
+
+    @classmethod
+    def _restore_links(cls, entries):
+        # A known file that went missing from PATH_NAME is linked back to
+        # its blob instead of being downloaded again
+        restored = 0
+        for url, entry in entries.iteritems():
+            path, sha256 = entry[0], entry[5]
+            if not(sha256):
+                continue
+            file_name_abs = os.path.join(FRBDownload.PATH_NAME, path)
+            blob = FRBDownload.blob_name(sha256)
+            if not(os.path.exists(file_name_abs)) and os.path.exists(blob):
+                FRBDownload._link(blob, file_name_abs)
+                restored += 1
+        if restored:
+            FRBDownload.LOGGER.info('Linked %d files back to stored blobs' % restored)
 
-        return [doc for doc in files if doc['File Name'] not in existing_files]
+    @classmethod
+    def _changed_files(cls, entries):
+        # HEAD every known URL and keep those whose validators changed
+        urls = list(entries)
+        changed = FetchPool.map(
+            lambda url: FRBDownload._remote_changed(url, entries[url]),
+            urls, lambda url: url, workers=FRBDownload.TRANSFERS)
+
+        files = [{'URL': url, 'File Name': entries[url][0], 'Changed': True}
+                 for url, is_changed in zip(urls, changed) if is_changed]
+        FRBDownload.LOGGER.info('%d of %d downloaded files changed on the server'
+            % (len(files), len(urls)))
+        return files
 
+    @classmethod
+    def _remote_changed(cls, url, entry):
+        path, size, etag, last_modified, content_length, sha256 = entry
+        try:
+            r = HTTPClient.head(url, allow_redirects=True)
+            r.close()
+        except requests.RequestException:
+            return False
+        if not(r.ok):
+            return False
+
+        remote_etag = r.headers.get('etag')
+        remote_modified = r.headers.get('last-modified')
+        if etag and remote_etag:
+            return etag != remote_etag
+        if last_modified and remote_modified:
+            return last_modified != remote_modified
+        try:
+            return int(r.headers.get('content-length')) != (content_length or size)
+        except (TypeError, ValueError):
+            return False
 
     @classmethod
     def set_working_path(cls, path):
         cls.PATH_NAME = os.path.join(path, cls.PATH_NAME)
+        cls.BLOB_PATH = os.path.join(path, cls.BLOB_PATH)
         #print cls.PATH_NAME
 
+    @classmethod
+    def make_local_name(cls, url):
+        file_name = url.split('/')[-1]
+        if 'aspx' in file_name.lower():
+            url_query = urlparse(url)[4] # query component
+            file_name = url_query.split('=')[1] # just the query value
+            file_name += '_stlfrb.pdf'
+        return file_name
+
     @classmethod
     def make_filename(cls, headers):
         for key, value in headers.iteritems():
@@ -0,0 +1,150 @@
+import json
+import logging
+import os
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from frblogger import replace_file
+
+
+class Scheduler(object):
+    """Polls each bank on its own interval, for --daemon.
+
+    A bank's interval halves after a run that stored new filings and doubles
+    after a run that found nothing new or failed. It stays between
+    MIN_INTERVAL and MAX_INTERVAL seconds. During filing season (FR Y-6
+    reports are due within 90 days of a December fiscal year end) it never
+    backs off past SEASON_MAX_INTERVAL.
+
+    After every run STATUS_FILE shows each bank's interval, last result
+    and next run.
+    """
+    LOGGER = logging.getLogger('root')
+
+    STATUS_FILE = 'frb_daemon_status.json'
+    MIN_INTERVAL = 30 * 60
+    MAX_INTERVAL = 24 * 3600
+    SEASON_MAX_INTERVAL = 2 * 3600
+    SEASON_MONTHS = (3, 4, 5)
+
+    @classmethod
+    def set_working_path(cls, path):
+        cls.STATUS_FILE = os.path.join(path, cls.STATUS_FILE)
+
+    @classmethod
+    def set_intervals(cls, min_minutes, max_minutes):
+        cls.MIN_INTERVAL = max(1, int(float(min_minutes) * 60))
+        cls.MAX_INTERVAL = max(cls.MIN_INTERVAL, int(float(max_minutes) * 60))
+
+    def __init__(self, banks, poll):
+        # poll(bank) runs one bank and returns the number of new filings
+        self.poll = poll
+        self.stopped = threading.Event()
+        now = time.time()
+        self.state = {}
+        for bank in banks:
+            self.state[bank] = {
+                'interval': Scheduler.MIN_INTERVAL,
+                'next_run': now,
+                'last_run': None,
+                'last_seconds': None,
+                'last_new': None,
+                'last_error': None,
+                'runs': 0,
+                'errors': 0,
+            }
+
+    def stop(self):
+        self.stopped.set()
+
+    def wait(self):
+        """Sleep until a bank is due. Returns False once stopped."""
+        while not(self.stopped.is_set()):
+            delay = min(s['next_run'] for s in self.state.itervalues()) - time.time()
+            if delay <= 0:
+                return True
+            # Wake at least once a minute, so a stop is never missed for long
+            self.stopped.wait(min(delay, 60))
+        return False
+
+    def run_due(self, jobs=1):
+        """Run every bank that is due, up to jobs at a time."""
+        now = time.time()
+        due = sorted((bank for bank, s in self.state.iteritems() if s['next_run'] <= now),
+                     key=lambda bank: bank.__name__)
+        if jobs > 1 and len(due) > 1:
+            pool = ThreadPool(min(jobs, len(due)))
+            try:
+                pool.map(self._run, due)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for bank in due:
+                self._run(bank)
+        self.write_status()
+        return due
+
+    def _run(self, bank):
+        state = self.state[bank]
+        start = time.time()
+        try:
+            new = self.poll(bank)
+            state['last_error'] = None
+        except Exception as e:
+            Scheduler.LOGGER.exception('%s run failed' % bank.__name__)
+            new = None
+            state['errors'] += 1
+            state['last_error'] = str(e)
+        finished = time.time()
+
+        state['runs'] += 1
+        state['last_run'] = finished
+        state['last_seconds'] = round(finished - start, 2)
+        state['last_new'] = new
+        state['interval'] = Scheduler.next_interval(state['interval'], new, finished)
+        state['next_run'] = finished + state['interval']
+        Scheduler.LOGGER.info('%s: %s new filings, next run in %d minutes'
+            % (bank.__name__, new if new is not None else 'no', state['interval'] // 60))
+
+    @staticmethod
+    def next_interval(interval, new, now=None):
+        if new:
+            interval = interval // 2
+        else:
+            interval = interval * 2
+        in_season = time.localtime(now).tm_mon in Scheduler.SEASON_MONTHS
+        ceiling = min(Scheduler.MAX_INTERVAL, Scheduler.SEASON_MAX_INTERVAL) if in_season \
+            else Scheduler.MAX_INTERVAL
+        return max(Scheduler.MIN_INTERVAL, min(interval, ceiling))
+
+    def status(self):
+        banks = {}
+        for bank, s in self.state.iteritems():
+            banks[bank.__name__] = {
+                'interval_minutes': round(s['interval'] / 60.0, 1),
+                'next_run': _timestamp(s['next_run']),
+                'last_run': _timestamp(s['last_run']),
+                'last_seconds': s['last_seconds'],
+                'last_new': s['last_new'],
+                'last_error': s['last_error'],
+                'runs': s['runs'],
+                'errors': s['errors'],
+            }
+        return {'updated': _timestamp(time.time()), 'pid': os.getpid(), 'banks': banks}
+
+    def write_status(self):
+        # Readers may look at any time; replace the file atomically
+        temp_name = Scheduler.STATUS_FILE + '.tmp'
+        try:
+            with open(temp_name, 'w') as outfile:
+                json.dump(self.status(), outfile, indent=2, sort_keys=True)
+            replace_file(temp_name, Scheduler.STATUS_FILE)
+        except (IOError, OSError) as e:
+            Scheduler.LOGGER.warning('Could not write %s: %s' % (Scheduler.STATUS_FILE, e))
+
+
+def _timestamp(seconds):
+    if seconds is None:
+        return None
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(seconds))
@@ -1,10 +1,24 @@
-import requests
-from requests import Session
-import lxml.html
 import logging
-import sys
+import parsing
+import requests
+from lxml import etree
+from urllib import urlencode
 from urlparse import urljoin
 from bankhandler import FRB
+from fetchpool import FetchPool
+from httpcache import HTTPCache
+from metrics import Metrics
+
+TABLE_ROWS = etree.XPath('body//table//tr')
+TABLE_HEADERS = etree.XPath('body//table//th')
+ROW_CELLS = etree.XPath('.//td')
+# The href of the first <a class="previewLink"> in a row
+PREVIEW_LINK = etree.XPath('(.//a[@class="previewLink"])[1]/@href')
+PAGER_ELEMENTS = etree.XPath('(//*[@id="searchResultsPager"])[1]/span/*')
+PAGE_SIZE_SELECT = etree.XPath(
+    '//select[contains(@name, "PageSize") or contains(@id, "PageSize")]')
+OPTION_VALUES = etree.XPath('option/@value')
+SELECTED_VALUE = etree.XPath('option[@selected]/@value')
 
 class StLouis(FRB):
     """ Contains all the FR-Y6 filing data scraped from the St. Louis FRB."""
@@ -16,13 +30,22 @@ class StLouis(FRB):
                     }
     DATE_FORMAT = ('%m/%d/%Y')
     BANK_CODE = 'S'
+    # 'auto' asks for the largest page size and fans out over the visible
+    # pager links; 'chain' follows one "next" postback at a time.
+    PAGER_MODE = 'auto'
+
+    @classmethod
+    def set_pager_mode(cls, mode):
+        cls.PAGER_MODE = mode
 
-    def __init__(self):
-        super(StLouis, self).__init__()
+    def __init__(self, run=True):
+        super(StLouis, self).__init__(run)
 
-    def scrape(self):
-        s = Session()
-        self.table_headers = []
+    def iter_pages(self):
+        self.page_requests = 0
+        self.payload_bytes = 0
+        self.since = self.since_year()
+        self.reached_known = False
 
         # first request
         request_headers = {}
@@ -30,54 +53,180 @@ class StLouis(FRB):
             request_headers[k] = v
 
         self.logger.info('Beginning scrape of stlouisfed.org')
-        req = requests.Request('POST', StLouis.URL, headers=request_headers)
-        prepped = s.prepare_request(req)
-        req_payload = self._parse_table(self.table_headers, self.documents, s.send(prepped))
-        self.logger.info('Initial request parsed %d rows' % len(self.documents))
-        page_requests = 1
+        page, rows = self._request_page(None, request_headers)
+        self.logger.info('Initial request parsed %d rows' % len(rows))
+        default_rows = len(rows)
+        serial_rounds = 1
 
+        if StLouis.PAGER_MODE != 'chain' and not(self.reached_known):
+            page, rows = self._request_largest_page(page, rows, request_headers)
+            serial_rounds += self.page_requests - 1
+        total_rows = len(rows)
+        yield rows
 
         # The "next" available pages are parsed and returned for each response
-        # Keep requesting new pages while some "next" page is parsed from the response
-        while (req_payload):
-            req = requests.Request('POST', StLouis.URL, data=req_payload, headers=request_headers)
-            prepped = s.prepare_request(req)
-            req_payload = self._parse_table(self.table_headers, self.documents, s.send(prepped))
-            page_requests += 1
-        self.logger.info('Completed %d total page requests. Parsed %d total rows' % 
-            (page_requests, len(self.documents)))
-
-    def _map_headers(self):
-        super(StLouis, self)._map_headers()
-        self.key_map['URL'] = 'URL'
-
-    def _parse_table(self, headers, data, resp=None):
-        # Do a POST if one has not occurred already
-        if not(resp):
-            resp = requests.post(StLouis.URL)
-
-        tree = lxml.html.fromstring(resp.text)
-
-        # Contents of hidden forms from this response will be used in the next POST
-        hidden_forms = self._get_hidden_elements(tree)
-        next_payload = self._get_form_attributes(hidden_forms)
+        # Keep requesting new pages while some "next" page is parsed from the response,
+        # unless an incremental crawl has reached documents that are already stored
+        while (page['next']) and not(self.reached_known):
+            if StLouis.PAGER_MODE == 'chain':
+                page, rows = self._request_page(page['next'], request_headers)
+                batches = [rows]
+            else:
+                page, batches = self._fan_out(page, request_headers)
+            serial_rounds += 1
+            for rows in batches:
+                total_rows += len(rows)
+                yield rows
+
+        if page.get('failed'):
+            self.logger.error('The crawl of %s ended at a page that could not be fetched; '
+                'later pages are missing' % StLouis.URL)
+            Metrics.incr(self.label, 'pages_failed')
+        if self.reached_known:
+            self.logger.info('Incremental crawl stopped at a page of already stored documents')
+        self.logger.info('Completed %d total page requests in %d serial rounds '
+            '(%d payload bytes). Parsed %d total rows' % (self.page_requests,
+            serial_rounds, self.payload_bytes, total_rows))
+
+        # Estimate what the default page size would have cost
+        if default_rows and self.page_requests:
+            default_pages = -(-total_rows // default_rows)
+            saved_pages = default_pages - self.page_requests
+            if saved_pages > 0:
+                self.logger.info('Saved ~%d page requests (~%d payload bytes) '
+                    'over %d rows per page' % (saved_pages,
+                    saved_pages * self.payload_bytes // self.page_requests, default_rows))
+
+    def _post(self, payload, request_headers):
+        # Every page is a POST back to the search form with the previous
+        # page's hidden ASP.NET state
+        self.page_requests += 1
+        if payload:
+            self.payload_bytes += len(urlencode(payload))
+        return self._send(payload, request_headers)
+
+    def _send(self, payload, request_headers):
+        # Returns None once HTTPClient has given up on the request
+        try:
+            return HTTPCache.request('POST', StLouis.URL, data=payload,
+                headers=request_headers)
+        except requests.RequestException as e:
+            self.logger.warning('No response: %s' % e)
+
+    def _request_page(self, payload, request_headers):
+        # Returns the parsed page and its documents
+        rows = []
+        page = self._parse_table(rows, self._post(payload, request_headers))
+        return page, rows
+
+    def _request_largest_page(self, page, rows, request_headers):
+        # Use the search form's page size control, when it has one, to ask
+        # for as many rows per page as the site allows
+        page_size = page.get('page_size')
+        if not(page_size) or page_size[2] <= page_size[1]:
+            return page, rows
+
+        control, current, largest = page_size
+        payload = dict(page['state'])
+        payload[control] = str(largest)
+        payload['__EVENTTARGET'] = control
+        payload['__EVENTARGUMENT'] = ''
+
+        big_page, big_rows = self._request_page(payload, request_headers)
+        if len(big_rows) <= len(rows):
+            return page, rows
+
+        # The larger first page replaces the default one
+        self.logger.info('Requested %d rows per page (default %d)' % (largest, current))
+        return big_page, big_rows
+
+    def _fan_out(self, page, request_headers):
+        # Every numbered page linked from the pager can be posted with this
+        # page's hidden state, so request them all at once. The last one
+        # carries the state needed for the pages beyond it.
+        # Returns the page to continue from and the documents of each page.
+        targets = [target for label, target in page.get('pages', []) if label.isdigit()]
+        if not(targets):
+            page, rows = self._request_page(page['next'], request_headers)
+            return page, [rows]
+
+        payloads = []
+        for target in targets:
+            payload = dict(page['state'])
+            payload['__EVENTTARGET'] = target
+            payload['__EVENTARGUMENT'] = ''
+            payloads.append(payload)
+            self.page_requests += 1
+            self.payload_bytes += len(urlencode(payload))
+
+        responses = FetchPool.map(
+            lambda payload: self._send(payload, request_headers),
+            payloads, lambda payload: StLouis.URL)
+
+        batches = []
+        for payload, resp in zip(payloads, responses):
+            rows = []
+            parsed = self._parse_table(rows, resp)
+            if parsed.get('failed'):
+                # One more try on its own before giving up on this page
+                self.page_requests += 1
+                parsed = self._parse_table(rows, self._send(payload, request_headers))
+            if parsed.get('failed'):
+                # Continue from the last good page, whose pager leads back
+                # to this one, and leave the pages after it for that round
+                if batches:
+                    break
+                return parsed, batches
+            page = parsed
+            batches.append(rows)
+        return page, batches
+
+    def _parse_table(self, data, resp):
+        if resp is None or not(resp.ok):
+            # Nothing to parse; end the crawl here
+            if resp is not None:
+                self.logger.warning('No response (HTTP %d) from %s'
+                    % (resp.status_code, StLouis.URL))
+            return {'headers': [], 'rows': [], 'next': None, 'state': {},
+                    'pages': [], 'page_size': None, 'failed': True}
+
+        # Reuse the parse of an identical page from an earlier run
+        page = HTTPCache.parsed(resp, self._parse_page)
+
+        # Pair each row of td_contents with this page's table headers
+        page_docs = []
+        if page['rows']:
+            page_docs = self.make_documents(page['headers'], page['rows'])
+        data += page_docs
+
+        if FRB.INCREMENTAL and page_docs:
+            if all(self._is_known(doc, self.since) for doc in page_docs):
+                self.reached_known = True
+
+        return page
+
+    def _parse_page(self, resp):
+        tree = parsing.html_tree(resp)
+
+        # The hidden elements __VIEWSTATE and __EVENTVALIDATION from this
+        # response are required for the next POST
+        state = parsing.hidden_fields(tree)
+        next_payload = dict(state)
 
         # Grab all the table rows on this page
         all_rows = self._parse_rows(tree)
 
-        # grab the headers
-        if not(headers):
-            self._parse_table_headers(tree, headers)
+        headers = []
+        self._parse_table_headers(tree, headers)
 
+        rows = []
         for row in all_rows:
             td_contents = self._parse_table_data(row)
             if td_contents:
-                # Pair into a dict each row of td_contents to the table headers
-                doc = dict(zip(headers, td_contents))
-                # Add this document result to the final list
-                data.append(doc)
+                rows.append(td_contents)
 
-        next_pagers = self._get_pagers(tree)
+        pager_links = self._get_pager_links(tree)
+        next_pagers = [target for label, target in pager_links]
 
         # When next_pagers is empty, we've reached the end of the content
         if next_pagers:
@@ -92,65 +241,55 @@ class StLouis(FRB):
             # Return None "next" payload when the "next" pager list is empty
             next_payload = None
 
-        return next_payload
-
-    def _get_hidden_elements(self, tree):
-        # The hidden elements __VIEWSTATE and __EVENTVALIDATION are required for
-        # subsequent post requests. Pull these elements from the source
-        return ([e for e in tree.xpath('//input[@type="hidden"]') if 
-                            '__' in e.attrib.get('name', None)])
-
-    def _get_form_attributes(self, form_elements):
-        attributes = {}
-
-        for elem in form_elements:
-                # Map the value of these hidden elements to its name
-                attributes[elem.name] = elem.attrib.get('value', None)
-
-        return attributes
+        return {'headers': headers, 'rows': rows, 'next': next_payload,
+                'state': state, 'pages': pager_links,
+                'page_size': self._get_page_size(tree)}
 
     def _parse_rows(self, tree):
-        return tree.xpath('body//table//tr')
+        return TABLE_ROWS(tree)
 
     def _parse_table_headers(self, tree, headers):
-        th_elements = tree.xpath('body//table//th')
-        headers += [''.join(e.xpath('.//text()')) for e in th_elements]
+        headers += [''.join(parsing.ALL_TEXT(e)) for e in TABLE_HEADERS(tree)]
         headers.append('URL')
 
     def _parse_table_data(self, tr):
         # Split the TR into its TDs. 
         # Pull text below each TD into a consolidated string.
-        contents = [''.join(''.join(e.xpath('.//text()')).split()) for e in tr.xpath('.//td')]
+        contents = [parsing.compact_text(e) for e in ROW_CELLS(tr)]
         if contents:
-            # In this row, get the first <a> where class=previewLink
-            link_element = tr.xpath('.//a[@class="previewLink"]')[0]
-            # Grab the href value from that <a>
-            url = urljoin(StLouis.URL, link_element.attrib.get('href', None))
+            # In this row, grab the href of the first previewLink <a>
+            href = PREVIEW_LINK(tr)[0]
             # Add this URL to the contents
-            contents.append(url)
+            contents.append(urljoin(StLouis.URL, href))
             return contents
         else:
             return None
 
-    def _get_pagers(self, tree):
-        pager_div = self._get_pager_div(tree)
-
+    def _get_pager_links(self, tree):
         next_pagers = []
         past_current_pager = False
 
         # The pager elements are below the <div><span> block
         # We only want the links beyond the current/active pager
-        for e in pager_div.xpath('span/*'):
+        for e in PAGER_ELEMENTS(tree):
             if (e.tag == 'a') & past_current_pager:
-                href = e.attrib.get('href', None)
-                next_pagers.append(href)
-            if (e.tag == 'span') & (e.attrib.get('class') == 'currentSearchPage'):
+                href = e.get('href', None)
+                next_pagers.append((''.join(parsing.ALL_TEXT(e)).strip(), href))
+            if (e.tag == 'span') & (e.get('class') == 'currentSearchPage'):
                 past_current_pager = True
 
-        # Return all strings like the one below from __doPostBack javascript <a> elements
+        # Pair the link text with strings like the one below from
+        # __doPostBack javascript <a> elements
         # ctl00$ContentPlaceHolder1$ucSearchReports$pgrSearchData$ctl00$ctl06
-        return [e for page in next_pagers for e in page.split("'") if 'SearchData' in e]
+        return [(label, e) for label, page in next_pagers
+                for e in page.split("'") if 'SearchData' in e]
 
-    def _get_pager_div(self, tree):
-        # Returns the first <div>, which containing the pagination elements
-        return tree.xpath('//*[@id="searchResultsPager"]')[0]
\ No newline at end of file
+    def _get_page_size(self, tree):
+        # Returns [control name, selected size, largest size] for the
+        # results-per-page <select>, or None when the form has none
+        for select in PAGE_SIZE_SELECT(tree):
+            sizes = [int(v) for v in OPTION_VALUES(select) if v.strip().isdigit()]
+            if not(sizes):
+                continue
+            selected = [int(v) for v in SELECTED_VALUE(select) if v.strip().isdigit()]
+            return [select.get('name'), selected[0] if selected else min(sizes), max(sizes)]
@@ -0,0 +1,166 @@
+import hashlib
+import logging
+import mmap
+import multiprocessing
+import os
+import time
+from jobqueue import DownloadQueue
+from resultshandler import FRBDownload
+
+PDF_HEADER = '%PDF-'
+PDF_TRAILER = '%%EOF'
+# Writers may put whitespace or junk after the last %%EOF
+TRAILER_WINDOW = 1024
+CHUNK_SIZE = 1 << 20
+
+
+def check_file(task):
+    """Hash and check one file. task is (path, file_name_abs). Returns
+    (path, sha256, error), with error None for a plausible PDF.
+
+    Runs in a pool process, so it only touches the file itself.
+    """
+    path, file_name_abs = task
+    try:
+        size = os.path.getsize(file_name_abs)
+        if not(size):
+            return path, hashlib.sha256().hexdigest(), 'Empty file'
+        with open(file_name_abs, 'rb') as infile:
+            data = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest = hashlib.sha256()
+                for offset in xrange(0, size, CHUNK_SIZE):
+                    digest.update(data[offset:offset + CHUNK_SIZE])
+                error = None
+                if data[:len(PDF_HEADER)] != PDF_HEADER:
+                    error = 'No PDF header'
+                elif data.rfind(PDF_TRAILER, max(0, size - TRAILER_WINDOW)) < 0:
+                    error = 'No PDF trailer (truncated?)'
+            finally:
+                data.close()
+        return path, digest.hexdigest(), error
+    except (IOError, OSError, ValueError, mmap.error) as e:
+        return path, None, str(e)
+
+
+class Auditor(object):
+    """Checks every file in FRBDownload.PATH_NAME, with files hashed and
+    checked in parallel by a pool of PROCESSES processes.
+
+    A file must be a PDF with its header and trailer markers. Its size must
+    match the recorded content-length, and its SHA-256 the recorded hash.
+    Results go into the audits table. A later audit skips files that passed
+    and whose size and mtime are unchanged. Broken files with a known URL
+    are queued for `scrapefrb worker` to download again.
+    """
+    LOGGER = logging.getLogger('root')
+
+    PROCESSES = None  # one per CPU
+    RECORD_BATCH = 500
+
+    @classmethod
+    def set_processes(cls, processes):
+        processes = int(processes)
+        cls.PROCESSES = processes if processes > 0 else None
+
+    def __init__(self, db, recheck=False):
+        self.db = db
+        self.recheck = recheck
+
+    def run(self):
+        """Audit the downloads directory and return a report dict."""
+        start = time.time()
+        manifest = self.db.manifest_by_path()
+        audits = {} if self.recheck else self.db.audit_entries()
+
+        tasks, stats, unchanged = self._plan(audits)
+        Auditor.LOGGER.info('Verifying %d files (%d unchanged since the last audit)'
+            % (len(tasks), unchanged))
+
+        broken = {}
+        checked = 0
+        records = []
+        pool = multiprocessing.Pool(Auditor.PROCESSES)
+        try:
+            for path, sha256, error in pool.imap_unordered(check_file, tasks, chunksize=8):
+                size, mtime = stats[path]
+                error = error or self._compare(manifest.get(path), size, sha256)
+                if error:
+                    broken[path] = error
+                records.append((path, size, mtime, sha256, error))
+                checked += 1
+                if len(records) >= Auditor.RECORD_BATCH:
+                    self.db.record_audits(records)
+                    records = []
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            if records:
+                self.db.record_audits(records)
+
+        queued = self._requeue(broken, manifest)
+        untracked = sorted(path for path in stats if path not in manifest)
+        diff = time.time() - start
+        Auditor.LOGGER.info('Verified %d files in %0.2f seconds: %d broken, %d queued for download'
+            % (checked, diff, len(broken), len(queued)))
+        for path, error in sorted(broken.iteritems()):
+            Auditor.LOGGER.warning('%s: %s' % (path, error))
+        return {
+            'seconds': round(diff, 4),
+            'checked': checked,
+            'unchanged': unchanged,
+            'broken': broken,
+            'queued': queued,
+            'untracked': untracked,
+        }
+
+    def _plan(self, audits):
+        # Stat every file. Returns the check tasks, {path: (size, mtime)}
+        # and the number of unchanged files that are skipped.
+        tasks = []
+        stats = {}
+        unchanged = 0
+        for path in sorted(os.listdir(FRBDownload.PATH_NAME)):
+            if path.endswith((FRBDownload.PART_SUFFIX, FRBDownload.VALIDATOR_SUFFIX)):
+                continue
+            file_name_abs = os.path.join(FRBDownload.PATH_NAME, path)
+            try:
+                st = os.stat(file_name_abs)
+            except OSError:
+                # A dangling link into the blob store
+                st = None
+            if st is not None and not(os.path.isfile(file_name_abs)):
+                continue
+            size, mtime = (st.st_size, st.st_mtime) if st else (None, None)
+            stats[path] = (size, mtime)
+            previous = audits.get(path)
+            if (st and previous and previous[0] == size and previous[1] == mtime
+                    and not(previous[3])):
+                unchanged += 1
+                continue
+            tasks.append((path, file_name_abs))
+        return tasks, stats, unchanged
+
+    def _compare(self, entry, size, sha256):
+        # Check a file against its manifest entry, if it has one
+        if entry is None:
+            return None
+        url, recorded_size, content_length, recorded_sha256 = entry
+        expected = content_length or recorded_size
+        if expected and size != expected:
+            return 'Size %d, expected %d' % (size, expected)
+        if recorded_sha256 and sha256 and sha256 != recorded_sha256:
+            return 'SHA-256 differs from the downloaded file'
+        return None
+
+    def _requeue(self, broken, manifest):
+        files = [{'URL': manifest[path][0], 'File Name': path, 'Changed': True}
+                 for path in sorted(broken) if path in manifest]
+        if files:
+            DownloadQueue.enqueue(files)
+            Auditor.LOGGER.info('Run scrapefrb worker to download the %d queued files'
+                % len(files))
+        return [f['File Name'] for f in files]